@@ -1,4 +1,5 @@
 import os
+import secrets
 import stripe
 from dotenv import load_dotenv
 
@@ -22,3 +23,75 @@ else:
 # Puedes inicializar el cliente Gemini aquí
 # from google import genai
 # client = genai.Client(api_key=GEMINI_API_KEY)
+
+# Cola de cumplimiento (Fulfillment Jobs)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "5"))
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", "300"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1.0"))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get("JOB_RETRY_BASE_SECONDS", "5"))
+
+# Cliente Gemini (concurrencia por proceso y pool de conexiones)
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "64"))
+GEMINI_MAX_CONNECTIONS = int(os.environ.get("GEMINI_MAX_CONNECTIONS", "100"))
+GEMINI_TIMEOUT_SECONDS = float(os.environ.get("GEMINI_TIMEOUT_SECONDS", "300"))
+
+# Caché de análisis (LRU en proceso + nivel opcional en la base de datos)
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "512"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.environ.get("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+ANALYSIS_CACHE_DB_ENABLED = os.environ.get("ANALYSIS_CACHE_DB_ENABLED", "false").lower() == "true"
+# Filas máximas del nivel DB (las más próximas a expirar se eliminan primero)
+ANALYSIS_CACHE_DB_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_DB_MAX_ENTRIES", "20000"))
+
+# Deduplicación de webhooks (LRU en memoria delante del registro en DB)
+WEBHOOK_DEDUPE_LRU_SIZE = int(os.environ.get("WEBHOOK_DEDUPE_LRU_SIZE", "10000"))
+
+# Subidas de archivos clínicos (lectura por bloques y volcado a disco)
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+UPLOAD_TEMP_DIR = os.environ.get("UPLOAD_TEMP_DIR", "temp")
+
+# Almacén de adjuntos direccionado por contenido (SHA-256) y su recolector de basura
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", os.path.join("storage", "blobs"))
+BLOB_GC_INTERVAL_SECONDS = int(os.environ.get("BLOB_GC_INTERVAL_SECONDS", "3600"))
+BLOB_GC_GRACE_SECONDS = int(os.environ.get("BLOB_GC_GRACE_SECONDS", "3600"))
+UPLOAD_TEMP_MAX_AGE_SECONDS = int(os.environ.get("UPLOAD_TEMP_MAX_AGE_SECONDS", "3600"))
+
+# Anonimizador (pool de procesos y tamaño de 'página' para texto plano/DOCX)
+ANONYMIZER_WORKERS = int(os.environ.get("ANONYMIZER_WORKERS", str(max(1, min(4, os.cpu_count() or 1)))))
+ANONYMIZER_PAGE_CHARS = int(os.environ.get("ANONYMIZER_PAGE_CHARS", "4000"))
+
+# Diccionarios PHI (nombres, apellidos, centros, lugares) y caché serializada del autómata
+PHI_DICTIONARY_DIR = os.environ.get("PHI_DICTIONARY_DIR", os.path.join("data", "phi_dictionaries"))
+PHI_AUTOMATON_CACHE = os.environ.get("PHI_AUTOMATON_CACHE", os.path.join("storage", "phi_automaton.pickle"))
+
+# Imágenes para el análisis multimodal (preprocesado en un pool de procesos y caché de derivados)
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "2048"))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "2"))
+IMAGE_OUTPUT_FORMAT = os.environ.get("IMAGE_OUTPUT_FORMAT", "jpeg").lower()  # jpeg | webp
+IMAGE_DERIVED_DIR = os.environ.get("IMAGE_DERIVED_DIR", os.path.join("storage", "derived"))
+IMAGE_DERIVED_MAX_AGE_SECONDS = int(os.environ.get("IMAGE_DERIVED_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+
+# Recursos estáticos: origen y salida del build (nombres con hash + .gz/.br + manifest.json)
+STATIC_SOURCE_DIR = os.environ.get("STATIC_SOURCE_DIR", "static")
+STATIC_BUILD_DIR = os.environ.get("STATIC_BUILD_DIR", os.path.join("storage", "static_build"))
+
+# Audio TTS del análisis (síntesis en el servidor, codificación en un pool y caché por contenido)
+TTS_MODEL = os.environ.get("TTS_MODEL", "gemini-2.5-flash-preview-tts")
+TTS_VOICE = os.environ.get("TTS_VOICE", "Kore")
+TTS_AUDIO_FORMAT = os.environ.get("TTS_AUDIO_FORMAT", "mp3").lower()  # mp3 | wav
+TTS_MP3_BITRATE = int(os.environ.get("TTS_MP3_BITRATE", "48"))  # kbps, voz mono
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "2"))
+TTS_AUDIO_DIR = os.environ.get("TTS_AUDIO_DIR", os.path.join("storage", "tts"))
+TTS_AUDIO_MAX_AGE_SECONDS = int(os.environ.get("TTS_AUDIO_MAX_AGE_SECONDS", str(30 * 24 * 3600)))
+# Clave HMAC de los tokens de POST /tts (propia: no se reutiliza ADMIN_BYPASS_KEY)
+TTS_TOKEN_SECRET = os.environ.get("TTS_TOKEN_SECRET")
+if not TTS_TOKEN_SECRET:
+    TTS_TOKEN_SECRET = secrets.token_hex(32)
+    print("ADVERTENCIA TTS: TTS_TOKEN_SECRET no configurada. Se usa una clave aleatoria por proceso: "
+          "los tokens de audio no valen entre workers ni tras un reinicio.")
+# Síntesis por fragmentos: el primero es corto para que la reproducción empiece en ~2 s
+TTS_CHUNK_CHARS = int(os.environ.get("TTS_CHUNK_CHARS", "1200"))
+TTS_FIRST_CHUNK_CHARS = int(os.environ.get("TTS_FIRST_CHUNK_CHARS", "300"))
+TTS_CHUNK_CONCURRENCY = int(os.environ.get("TTS_CHUNK_CONCURRENCY", "4"))
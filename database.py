@@ -1,6 +1,11 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import asyncio
 import os
+import threading
+import time
+from contextlib import contextmanager
 from models import Base # <--- CORRECCIÓN CLAVE: Importa Base desde models.py
 
 # Asumimos que la URL de la DB está en una variable de entorno de Render
@@ -10,7 +15,42 @@ DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./ateneo_test.db")
 if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
-engine = create_engine(DATABASE_URL)
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+# Configuración del pool (por worker de uvicorn/gunicorn) desde el entorno
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# Render Postgres cierra conexiones inactivas: se reciclan antes de que caduquen
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", "1800"))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# Una sesión de trabajo en segundo plano abierta más de este tiempo se reporta como posible fuga
+DB_SESSION_LEAK_SECONDS = int(os.environ.get("DB_SESSION_LEAK_SECONDS", "120"))
+
+if IS_SQLITE:
+    # Sesiones usadas desde asyncio.to_thread/BackgroundTasks cruzan hilos
+    connect_args = {"check_same_thread": False, "timeout": DB_STATEMENT_TIMEOUT_MS / 1000}
+else:
+    connect_args = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,  # Descarta conexiones muertas tras periodos de inactividad
+    connect_args=connect_args,
+)
+
+if IS_SQLITE:
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL: lectores concurrentes no bloquean al escritor (cola de trabajos + peticiones)
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={DB_STATEMENT_TIMEOUT_MS}")
+        cursor.close()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -20,3 +60,205 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# =========================================================================
+# SESIONES PARA TAREAS EN SEGUNDO PLANO Y WORKERS (con detección de fugas)
+# =========================================================================
+
+_active_sessions = {}  # id(sesión) -> [inicio, etiqueta, ya_avisada]
+_session_stats = {"opened": 0, "closed": 0, "leak_warnings": 0}
+_sessions_lock = threading.Lock()
+
+
+@contextmanager
+def session_scope(label: str = "background"):
+    """
+    Sesión con ciclo de vida garantizado para código fuera de una petición
+    (BackgroundTasks, cola de trabajos, servicios). Reemplaza get_db().__next__(),
+    cuyo finally nunca se ejecuta y deja la conexión fuera del pool.
+    """
+    db = SessionLocal()
+    key = id(db)
+    with _sessions_lock:
+        _active_sessions[key] = [time.monotonic(), label, False]
+        _session_stats["opened"] += 1
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+        with _sessions_lock:
+            started, _, warned = _active_sessions.pop(key)
+            _session_stats["closed"] += 1
+        age = time.monotonic() - started
+        if age > DB_SESSION_LEAK_SECONDS and not warned:
+            print(f"ADVERTENCIA DB: La sesión '{label}' estuvo abierta {age:.1f}s (límite {DB_SESSION_LEAK_SECONDS}s).")
+
+
+def check_long_lived_sessions():
+    """Avisa (una vez por sesión) de las sesiones abiertas más allá de DB_SESSION_LEAK_SECONDS."""
+    now = time.monotonic()
+    with _sessions_lock:
+        for entry in _active_sessions.values():
+            started, label, warned = entry
+            if not warned and now - started > DB_SESSION_LEAK_SECONDS:
+                entry[2] = True
+                _session_stats["leak_warnings"] += 1
+                print(f"ADVERTENCIA DB: Posible fuga, la sesión '{label}' lleva {now - started:.1f}s abierta.")
+
+
+def session_stats():
+    now = time.monotonic()
+    with _sessions_lock:
+        ages = [now - entry[0] for entry in _active_sessions.values()]
+        return {
+            **_session_stats,
+            "active": len(ages),
+            "oldest_age_s": round(max(ages), 1) if ages else 0.0,
+            "leak_threshold_s": DB_SESSION_LEAK_SECONDS,
+        }
+
+
+async def session_leak_watchdog():
+    """Tarea periódica (arrancada en startup) que revisa sesiones de larga duración."""
+    while True:
+        await asyncio.sleep(max(DB_SESSION_LEAK_SECONDS / 2, 1))
+        check_long_lived_sessions()
+
+
+# =========================================================================
+# MOTOR ASÍNCRONO (asyncpg / aiosqlite) PARA LOS ROUTERS
+# =========================================================================
+
+def _async_url(url: str) -> str:
+    """Traduce la URL síncrona al driver asíncrono equivalente."""
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite:///"):
+        return url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    return url
+
+ASYNC_DATABASE_URL = _async_url(DATABASE_URL)
+
+if IS_SQLITE:
+    async_connect_args = {"timeout": DB_STATEMENT_TIMEOUT_MS / 1000}
+else:
+    async_connect_args = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    connect_args=async_connect_args,
+)
+
+if IS_SQLITE:
+    event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+# expire_on_commit=False: los objetos siguen siendo legibles tras commit sin I/O implícito
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+async def get_async_db():
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+def _add_missing_columns():
+    """Añade a las tablas existentes las columnas nuevas que admiten NULL (sin migraciones)."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"INFO DB: Columna {table.name}.{column.name} añadida.")
+            except Exception as e:
+                print(f"ERROR DB: No se pudo añadir la columna {table.name}.{column.name}: {e}")
+
+
+def _dedupe_case_session_ids():
+    """
+    Antes del índice UNIQUE de cases.stripe_session_id: las filas antiguas usaban marcadores
+    fijos ('DEV_BYPASS', 'DEVELOPER_FREE_ACCESS') y podían repetir sesión. Se añade el id
+    de la fila a cada marcador y a los duplicados (salvo la fila más antigua) para que el índice se pueda crear.
+    """
+    if "cases" not in inspect(engine).get_table_names():
+        return
+    suffixed = "stripe_session_id || ':' || CAST(id AS VARCHAR)"
+    with engine.begin() as conn:
+        markers = conn.execute(text(
+            f"UPDATE cases SET stripe_session_id = {suffixed} "
+            "WHERE stripe_session_id IN ('DEV_BYPASS', 'DEVELOPER_FREE_ACCESS')"
+        )).rowcount
+        duplicates = conn.execute(text(
+            f"UPDATE cases SET stripe_session_id = {suffixed} "
+            "WHERE stripe_session_id IN (SELECT stripe_session_id FROM cases "
+            "WHERE stripe_session_id IS NOT NULL GROUP BY stripe_session_id HAVING COUNT(*) > 1) "
+            "AND id NOT IN (SELECT MIN(id) FROM cases WHERE stripe_session_id IS NOT NULL GROUP BY stripe_session_id)"
+        )).rowcount
+    if markers or duplicates:
+        print(f"INFO DB: stripe_session_id normalizado en {markers} casos con marcador y {duplicates} duplicados.")
+
+
+def init_db():
+    """
+    Crea las tablas nuevas, y las columnas (nullables) e índices declarados en los
+    modelos que falten en tablas ya existentes (create_all no altera tablas creadas previamente).
+    Un índice UNIQUE que no se pueda crear es fatal: los upserts ON CONFLICT dependen de él.
+    """
+    Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+    _dedupe_case_session_ids()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                if index.unique:
+                    raise RuntimeError(f"No se pudo crear el índice único {index.name}: {e}") from e
+                print(f"ERROR DB: No se pudo crear el índice {index.name}: {e}")
+
+
+def pool_status():
+    """Indicadores del pool de conexiones y latencia de un ping (para /health/db)."""
+    pool = engine.pool
+    status = {
+        "dialect": engine.dialect.name,
+        "pool_class": type(pool).__name__,
+    }
+    for gauge in ("size", "checkedin", "checkedout", "overflow"):
+        if hasattr(pool, gauge):
+            status[gauge] = getattr(pool, gauge)()
+    status["max_overflow"] = DB_MAX_OVERFLOW
+    # Pool del motor asíncrono (routers)
+    status["async_pool"] = {
+        gauge: getattr(async_engine.pool, gauge)()
+        for gauge in ("size", "checkedin", "checkedout", "overflow")
+        if hasattr(async_engine.pool, gauge)
+    }
+
+    status["sessions"] = session_stats()
+
+    started = time.perf_counter()
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        status["ok"] = True
+    except Exception as e:
+        status["ok"] = False
+        status["error"] = str(e)
+    status["ping_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return status
@@ -1,16 +1,39 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from typing import Optional, Any, Dict, List
 import os
 import json
+import re
 import stripe
-from google import genai
+from google.genai import types
 from google.genai.errors import APIError
 import asyncio
 import time
-import base64
+from urllib.parse import quote
 from routes import payments
+from models import User
+from utils import get_current_user
+from database import async_engine, init_db, pool_status, session_leak_watchdog
+from services import job_queue
+from services import case_service
+from services import case_events
+from services import gemini_client as gemini
+from services import stream_hub
+from services import webhook_events
+from services.analysis_cache import analysis_cache, make_cache_key
+from services.uploads import spool_upload
+from services import blob_store
+from services import anonymizer
+from services import phi_automaton
+from services import images
+from services import token_budget
+from services.precompressed import PrecompressedBody
+from services import static_assets
+from services import tts
+from config import BLOB_GC_INTERVAL_SECONDS
+from config import STATIC_BUILD_DIR
+from config import UPLOAD_MAX_BYTES
 app = FastAPI()
 
 # Registrar el router de pagos
@@ -43,17 +66,25 @@ ADDONS = {
     "tts_audio": {"name": "Audio Profesional del Análisis (TTS)", "price": 3, "tiers_included": [3, 4, 5]}, # Incluido en Nivel 3, 4, 5
 }
 
+# PRESUPUESTOS DE TOKENS POR NIVEL (aplicados por la API vía GenerateContentConfig, no solo en prosa)
+# max_output_tokens deja margen sobre el límite de palabras del nivel (~2 tokens por palabra en español con formato).
+# max_input_tokens acota la descripción del caso; thinking_budget son tokens de razonamiento adicionales.
+TIER_BUDGETS = {
+    1: {"max_input_tokens": 2000, "max_output_tokens": 600, "temperature": 0.3, "thinking_budget": 0},
+    2: {"max_input_tokens": 4000, "max_output_tokens": 1500, "temperature": 0.4, "thinking_budget": 0},
+    3: {"max_input_tokens": 8000, "max_output_tokens": 2500, "temperature": 0.5, "thinking_budget": 1024},
+    4: {"max_input_tokens": 12000, "max_output_tokens": 4000, "temperature": 0.6, "thinking_budget": 2048},
+    5: {"max_input_tokens": 24000, "max_output_tokens": 8000, "temperature": 0.6, "thinking_budget": 4096},
+}
+# El add-on de imagen pide ~200 palabras más
+IMAGE_ADDON_OUTPUT_TOKENS = 400
+
 # Inicialización de Stripe
 if STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
 
-# Inicialización del Cliente de Gemini
-gemini_client = None
-if GEMINI_API_KEY:
-    try:
-        gemini_client = genai.Client(api_key=GEMINI_API_KEY)
-    except Exception as e:
-        print(f"Error inicializando el cliente de Gemini: {e}")
+# Inicialización del Cliente de Gemini (asíncrono, pool de conexiones compartido en services/gemini_client.py)
+gemini_client = gemini.gemini_client
 
 # Inicialización de la aplicación FastAPI
 app = FastAPI(title="Ateneo Clínico IA Backend API")
@@ -68,27 +99,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Recursos estáticos con hash de contenido (build en el arranque si el origen cambió)
+app.mount("/static", static_assets.PrecompressedStaticFiles(directory=STATIC_BUILD_DIR), name="static")
+
+# Margen para los campos de texto y los delimitadores del multipart
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """
+    Rechaza subidas declaradas por encima del límite antes de parsear el multipart,
+    sin leer el cuerpo. Las subidas sin Content-Length se cortan luego en spool_upload.
+    """
+    content_length = request.headers.get("content-length")
+    if (request.method == "POST" and content_length and content_length.isdigit()
+            and int(content_length) > UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD_BYTES):
+        return JSONResponse(
+            status_code=413,
+            content={"detail": f"El archivo supera el tamaño máximo permitido ({UPLOAD_MAX_BYTES // (1024 * 1024)} MB)."},
+        )
+    return await call_next(request)
+
 # =========================================================================
 # 2. UTILITY FUNCTIONS (Funciones de Soporte)
 # =========================================================================
 
-async def call_gemini_api(prompt: str, token_instruction: str, image_data: Optional[bytes] = None):
+def build_system_instruction(token_instruction: str) -> str:
     """
-    Genera el análisis clínico con instrucciones específicas para control de tokens
-    y maneja la entrada multimodal (texto + imagen).
+    CONSTRUCCIÓN DE LA INSTRUCCIÓN DEL SISTEMA (MODIFICADO: Sin mención a Gemini + Preguntas Obligatorias)
+    Se añade la instrucción de tratamiento hipotético directamente al prompt system para controlar el formato
+    y la instrucción de la advertencia.
     """
-    if not gemini_client:
-        return {
-            "analysis_status": "error",
-            "reason": "GEMINI_API_KEY no configurada. El servicio de análisis de IA está DESACTIVADO.",
-            "prompt_used": prompt
-        }
-   
-    # 1. CONSTRUCCIÓN DE LA INSTRUCCIÓN DEL SISTEMA (MODIFICADO: Sin mención a Gemini + Preguntas Obligatorias)
-    # Se añade la instrucción de tratamiento hipotético directamente al prompt system para controlar el formato
-    # y la instrucción de la advertencia.
-   
-    system_instruction = (
+    return (
         f"Eres un analista clínico experto que debe actuar como un humano profesional. {token_instruction} "
         "Analiza el caso. Detecta automáticamente el idioma de la consulta y responde íntegramente en ese mismo idioma. "
         "El Tratamiento Hipotético (Simulación) o Tratamiento Medicamentoso siempre debe aparecer al final en una sección propia "
@@ -98,43 +140,111 @@ async def call_gemini_api(prompt: str, token_instruction: str, image_data: Optio
         "El análisis es generado por el ATENEO CLÍNICO IA." # <<-- INSTRUCCIÓN CRÍTICA DE LENGUAJE
     )
 
-    # 2. CONSTRUCCIÓN DE LA ENTRADA MULTIMODAL (parts)
+
+def build_gemini_parts(prompt: str, image_data: Optional[bytes] = None, mime_type: Optional[str] = None) -> List[types.Part]:
+    """CONSTRUCCIÓN DE LA ENTRADA MULTIMODAL (parts)."""
     parts = []
    
-    # Agregar la imagen si existe
-    if image_data:
-        # Nota: La simulación de archivo aquí asume que es una imagen simple (e.g., JPEG/PNG).
-        # Usamos 'image/jpeg' como un MIME type de fallback.
-        parts.append({
-            "inlineData": {
-                "mimeType": "image/jpeg",
-                "data": image_data.decode('latin1') # Decodificación simple a base64
-            }
-        })
+    # Agregar la imagen si existe: bytes crudos (el SDK serializa una sola vez) y MIME detectado
+    if image_data and mime_type:
+        parts.append(types.Part.from_bytes(data=image_data, mime_type=mime_type))
        
     # Agregar el texto del prompt
-    parts.append({"text": prompt})
+    parts.append(types.Part.from_text(text=prompt))
+    return parts
 
 
-    def blocking_call():
-        """Función síncrona que envuelve la llamada al cliente de Gemini (Texto/Multimodal)."""
-        response = gemini_client.models.generate_content(
-            model='gemini-2.5-flash',
+def with_tts_token(analysis_result: Dict[str, Any], tts_included: bool) -> Dict[str, Any]:
+    """Adjunta el token para POST /tts si el add-on de audio está pagado o incluido en el nivel."""
+    text = analysis_result.get("analysis_text")
+    if not tts_included or analysis_result.get("analysis_status") != "success" or not text:
+        return analysis_result
+    return {**analysis_result, "tts_token": tts.issue_token(text)}
+
+
+def tier_budget(level: int, include_image_analysis: bool = False) -> Dict[str, Any]:
+    """Presupuesto de tokens del nivel, ampliado si se contrató el análisis de imagen."""
+    budget = dict(TIER_BUDGETS.get(level, TIER_BUDGETS[1]))
+    if include_image_analysis:
+        budget["max_output_tokens"] += IMAGE_ADDON_OUTPUT_TOKENS
+    return budget
+
+
+def build_usage(budget: Optional[Dict[str, Any]], estimated_prompt_tokens: int, prompt_truncated: bool,
+                usage_metadata: Any = None, finish_reason: Any = None, started_at: Optional[float] = None,
+                cached: bool = False) -> Dict[str, Any]:
+    """Registro de consumo por análisis (se persiste en el Case como prompt/completion tokens)."""
+    usage = token_budget.usage_from_metadata(usage_metadata) if not cached else \
+        {"prompt_tokens": 0, "completion_tokens": 0, "thoughts_tokens": 0}
+    usage.update({
+        "estimated_prompt_tokens": estimated_prompt_tokens,
+        "prompt_truncated": prompt_truncated,
+        "max_output_tokens": budget["max_output_tokens"] if budget else None,
+        "output_truncated": str(finish_reason).endswith("MAX_TOKENS") if finish_reason else False,
+        "latency_ms": round((time.perf_counter() - started_at) * 1000) if started_at else None,
+        "cached": cached,
+    })
+    return usage
+
+
+def require_complete_response(text: Optional[str], finish_reason: Any):
+    """
+    Solo una respuesta con texto y terminada en STOP se cachea y se persiste; una vacía,
+    bloqueada (SAFETY) o cortada (MAX_TOKENS) se propaga como error para que el trabajo se reintente.
+    """
+    if not text or not text.strip():
+        raise RuntimeError(f"Respuesta vacía de Gemini (finish_reason={finish_reason}).")
+    if finish_reason != types.FinishReason.STOP:
+        raise RuntimeError(f"Respuesta incompleta de Gemini (finish_reason={finish_reason}).")
+
+
+async def call_gemini_api(prompt: str, token_instruction: str, image_data: Optional[bytes] = None,
+                          budget: Optional[Dict[str, Any]] = None):
+    """
+    Genera el análisis clínico con instrucciones específicas para control de tokens
+    y maneja la entrada multimodal (texto + imagen).
+    Con budget (ver tier_budget) la descripción se recorta a max_input_tokens y la respuesta
+    se limita con max_output_tokens/temperature; el consumo real va en analysis_result["usage"].
+    """
+    if not gemini_client:
+        return {
+            "analysis_status": "error",
+            "reason": "GEMINI_API_KEY no configurada. El servicio de análisis de IA está DESACTIVADO.",
+            "prompt_used": prompt
+        }
+   
+    started_at = time.perf_counter()
+    prompt, estimated_tokens, truncated = token_budget.fit_to_budget(prompt, budget and budget["max_input_tokens"])
+    system_instruction = build_system_instruction(token_instruction)
+
+    # Caché direccionada por contenido: casos repetidos no vuelven a pagar una llamada al modelo
+    cache_key = make_cache_key(gemini.GEMINI_MODEL, system_instruction, prompt, image_data,
+                               config_signature=token_budget.budget_signature(budget))
+    cached = await analysis_cache.get(cache_key)
+    if cached is not None:
+        return {**cached, "usage": build_usage(budget, estimated_tokens, truncated, started_at=started_at, cached=True)}
+
+    try:
+        # Tras la caché: MIME real, reducción, recodificación y borrado de EXIF (pool de procesos)
+        model_image, mime_type = await images.prepare_for_model(image_data) if image_data else (None, None)
+        parts = build_gemini_parts(prompt, model_image, mime_type)
+
+        # Llamada nativa asíncrona: no ocupa un hilo del threadpool y respeta GEMINI_MAX_CONCURRENCY
+        response = await gemini.generate_content(
             contents=parts, # Usa las partes (imagen + texto)
-            config=dict(
-                system_instruction=system_instruction
-            )
+            config=token_budget.build_generation_config(system_instruction, budget)
         )
-        return response.text
-       
-    try:
-        # Ejecutar la llamada a la API en un hilo separado para no bloquear la ejecución asíncrona de FastAPI
-        analysis_text = await asyncio.to_thread(blocking_call)
+        analysis_text = response.text
+        finish_reason = response.candidates[0].finish_reason if response.candidates else None
+        require_complete_response(analysis_text, finish_reason)
        
-        return {
+        analysis_result = {
             "analysis_status": "success",
             "analysis_text": analysis_text
         }
+        await analysis_cache.set(cache_key, analysis_result)
+        return {**analysis_result, "usage": build_usage(budget, estimated_tokens, truncated, response.usage_metadata,
+                                                        finish_reason, started_at)}
            
     except APIError as e:
         print(f"Error de API de Gemini: {e}")
@@ -152,6 +262,77 @@ async def call_gemini_api(prompt: str, token_instruction: str, image_data: Optio
         }
 
 
+async def stream_gemini_api(prompt: str, token_instruction: str, image_data: Optional[bytes] = None,
+                            budget: Optional[Dict[str, Any]] = None, usage: Optional[Dict[str, Any]] = None):
+    """
+    Versión en streaming de call_gemini_api: produce fragmentos de texto a medida que el modelo
+    los genera (primer byte en < 1 s en lugar de esperar el texto completo).
+    Los errores se propagan al consumidor, que decide cómo notificarlos.
+    Si se pasa usage, al terminar contiene el mismo registro de consumo que call_gemini_api.
+    """
+    if not gemini_client:
+        raise RuntimeError("GEMINI_API_KEY no configurada. El servicio de análisis de IA está DESACTIVADO.")
+
+    started_at = time.perf_counter()
+    prompt, estimated_tokens, truncated = token_budget.fit_to_budget(prompt, budget and budget["max_input_tokens"])
+    system_instruction = build_system_instruction(token_instruction)
+    cache_key = make_cache_key(gemini.GEMINI_MODEL, system_instruction, prompt, image_data,
+                               config_signature=token_budget.budget_signature(budget))
+    cached = await analysis_cache.get(cache_key)
+    if cached is not None:
+        if usage is not None:
+            usage.update(build_usage(budget, estimated_tokens, truncated, started_at=started_at, cached=True))
+        yield cached["analysis_text"]
+        return
+
+    model_image, mime_type = await images.prepare_for_model(image_data) if image_data else (None, None)
+    chunks = []
+    stream_usage: Dict[str, Any] = {}
+    async for text in gemini.generate_content_stream(
+        contents=build_gemini_parts(prompt, model_image, mime_type),
+        config=token_budget.build_generation_config(system_instruction, budget),
+        usage=stream_usage,
+    ):
+        chunks.append(text)
+        yield text
+
+    if usage is not None:
+        usage.update(build_usage(budget, estimated_tokens, truncated, stream_usage.get("usage_metadata"),
+                                 stream_usage.get("finish_reason"), started_at))
+    # Solo se cachea un stream completo (si el cliente se desconecta no se llega aquí) y terminado en STOP
+    analysis_text = "".join(chunks)
+    require_complete_response(analysis_text, stream_usage.get("finish_reason"))
+    await analysis_cache.set(cache_key, {"analysis_status": "success", "analysis_text": analysis_text})
+
+
+async def stream_analysis_to_channel(channel_key: str, prompt: str, token_instruction: str, image_data: Optional[bytes] = None,
+                                    budget: Optional[Dict[str, Any]] = None):
+    """
+    Ejecuta el análisis en streaming publicando cada fragmento en el canal SSE indicado.
+    Devuelve el mismo formato que call_gemini_api para que el resto del flujo no cambie.
+    """
+    stream_hub.open_channel(channel_key)
+    chunks = []
+    usage: Dict[str, Any] = {}
+    try:
+        async for text in stream_gemini_api(prompt, token_instruction, image_data, budget=budget, usage=usage):
+            chunks.append(text)
+            stream_hub.publish(channel_key, "chunk", {"text": text})
+    except Exception as e:
+        print(f"Error en streaming con Gemini: {e}")
+        analysis_result = {
+            "analysis_status": "error",
+            "reason": f"Error al generar el análisis en streaming: {e}",
+            "prompt_used": prompt
+        }
+        stream_hub.close_channel(channel_key, "error", analysis_result)
+        return analysis_result
+
+    analysis_result = {"analysis_status": "success", "analysis_text": "".join(chunks), "usage": usage}
+    stream_hub.close_channel(channel_key, "done", analysis_result)
+    return analysis_result
+
+
 def create_stripe_checkout_session(total_price: int, product_name: str, metadata: dict, line_items: List[Dict]):
     """Crea una sesión de Stripe Checkout con múltiples line_items para los add-ons."""
    
@@ -180,10 +361,11 @@ def create_stripe_checkout_session(total_price: int, product_name: str, metadata
         raise HTTPException(status_code=500, detail="Error desconocido al crear la sesión de pago.")
 
 
-async def fulfill_case(metadata: Dict[str, Any]):
+async def fulfill_case(metadata: Dict[str, Any], stream_channel: Optional[str] = None, case_id: Optional[int] = None):
     """
     Función de cumplimiento que se ejecuta DESPUÉS de un pago exitoso (via Webhook).
     Esta es la ruta crítica para el control de tokens y add-ons.
+    Si se indica stream_channel, el texto se publica progresivamente (GET /cases/by-session/{session_id}/stream y /jobs/{public_id}/stream).
     """
     user_id = metadata.get("user_id", "Unknown")
     level = int(metadata.get("service_level", 1))
@@ -205,20 +387,126 @@ async def fulfill_case(metadata: Dict[str, Any]):
         image_data_simulated = False
        
    
-    description_snippet = metadata.get("description_snippet", "Caso clínico no especificado.")
+    description_snippet = anonymizer.redact_text(metadata.get("description_snippet", "Caso clínico no especificado."))
     prompt = f"Analizar el siguiente caso clínico: {description_snippet}"
    
     # SIMULACIÓN DE LA LLAMADA: Asumimos que no hay datos binarios reales para la imagen en el webhook
-    analysis_result = await call_gemini_api(prompt, token_instruction, image_data=None)
+    budget = tier_budget(level, include_image_analysis)
+    if stream_channel:
+        analysis_result = await stream_analysis_to_channel(stream_channel, prompt, token_instruction, image_data=None, budget=budget)
+    else:
+        analysis_result = await call_gemini_api(prompt, token_instruction, image_data=None, budget=budget)
    
     print(f" Análisis de IA completado (Nivel {level}) para el usuario {user_id}. Estado: {analysis_result.get('analysis_status')}")
    
     # REGISTRO AUTOMÁTICO CRÍTICO:
-    print(f"REGISTRO AUTOMÁTICO: Caso ID: XXX, Nivel: {level}, Pagó Imagen: {include_image_analysis}, Pagó Audio: {metadata.get('tts_audio')}")
+    print(f"REGISTRO AUTOMÁTICO: Caso ID: {case_id}, Nivel: {level}, Pagó Imagen: {include_image_analysis}, Pagó Audio: {metadata.get('tts_audio')}")
 
     return analysis_result
 
 
+def fulfillment_channel(session_id: str) -> str:
+    """Canal SSE del texto del cumplimiento, por sesión de Stripe: la página de éxito solo conoce ese id."""
+    return f"fulfillment:{session_id}"
+
+
+async def run_fulfillment_job(job_id: int, payload: Dict[str, Any]):
+    """
+    Manejador de la cola: persiste el resultado en Case (upsert idempotente por stripe_session_id).
+    Si el caso ya está 'completed' (reentrega de Stripe o reintento), no se repite la llamada a la IA.
+    Un error de IA se propaga para que el trabajo se reintente con backoff (el caso queda 'retrying').
+    """
+    metadata = payload["metadata"]
+    level = int(metadata.get("service_level", 1))
+    description_snippet = metadata.get("description_snippet", "Caso clínico no especificado.")
+    case = await asyncio.to_thread(case_service.upsert_paid_case, payload["session_id"], {
+        "volunteer_id": int(metadata["user_id"]) if str(metadata.get("user_id", "")).isdigit() else None,
+        "title": description_snippet[:50],
+        "description": description_snippet,
+        "price_paid": TIERS.get(level, TIERS[1])["price"],
+        "has_legal_consent": metadata.get("has_legal_consent") == "true",
+    })
+    case_events.publish_case(case, payload["session_id"])
+    if case["status"] == "completed":
+        print(f" Caso {case['case_id']} ya completado para la sesión {payload['session_id']}. Se omite la IA.")
+        return with_tts_token({"case_id": case["case_id"], "analysis_status": "success", "analysis_text": case["ai_result"]},
+                              metadata.get("tts_audio") == "true")
+
+    analysis_result = await fulfill_case(metadata, stream_channel=fulfillment_channel(payload["session_id"]), case_id=case["case_id"])
+    saved = await asyncio.to_thread(case_service.save_case_result, case["case_id"], analysis_result)
+    if saved:
+        # Push a los clientes suscritos (GET /cases/{id}/events): se enteran sin sondear
+        case_events.publish_case(saved, payload["session_id"])
+    if analysis_result.get("analysis_status") != "success" or not analysis_result.get("analysis_text"):
+        raise RuntimeError(analysis_result.get("reason", "Análisis de IA fallido."))
+    return with_tts_token({"case_id": case["case_id"], **analysis_result}, metadata.get("tts_audio") == "true")
+
+
+async def give_up_fulfillment_job(job_id: int, payload: Dict[str, Any], error: str):
+    """La cola agotó los intentos: recién aquí el caso pasa a 'error' y se notifica a los suscriptores."""
+    case = await asyncio.to_thread(case_service.mark_case_failed, payload["session_id"], error)
+    if case:
+        case_events.publish_case(case, payload["session_id"])
+
+
+job_queue.register_handler("fulfill_case", run_fulfillment_job, on_give_up=give_up_fulfillment_job)
+
+
+def run_storage_maintenance() -> Dict[str, int]:
+    """
+    Limpieza periódica: adjuntos huérfanos y temporales, variantes de imagen y audios TTS sin uso,
+    y filas expiradas (o sobrantes) del nivel DB de la caché de análisis.
+    """
+    removed = dict(blob_store.collect_garbage())
+    removed["analysis_cache"] = analysis_cache.prune_db()
+    # Variantes de imagen preprocesadas sin uso reciente (se regeneran bajo demanda)
+    removed["derived"] = images.prune_derived_cache()
+    # Audios TTS no reproducidos en TTS_AUDIO_MAX_AGE_SECONDS (se vuelven a sintetizar bajo demanda)
+    removed["tts"] = tts.prune_audio_cache()
+    if removed["derived"] or removed["tts"] or removed["analysis_cache"]:
+        print(f"INFO: Mantenimiento: {removed['derived']} derivados de imagen, {removed['tts']} audios TTS "
+              f"y {removed['analysis_cache']} entradas de la caché de análisis eliminados.")
+    return removed
+
+
+async def storage_maintenance_loop(interval: float = BLOB_GC_INTERVAL_SECONDS):
+    """Tarea de fondo: ejecuta run_storage_maintenance periódicamente fuera del event loop."""
+    while True:
+        try:
+            await asyncio.to_thread(run_storage_maintenance)
+        except Exception as e:
+            print(f"ERROR GC: Mantenimiento de almacenamiento fallido: {e}")
+        await asyncio.sleep(interval)
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    # Crea tablas/índices faltantes y arranca el pool acotado de workers
+    init_db()
+    # El autómata PHI se carga (o se construye y serializa) una vez, no en la primera petición
+    await asyncio.to_thread(phi_automaton.get_automaton)
+    # Igual con el tokenizador local: la primera llamada descarga su vocabulario (ver token_budget._get_tokenizer)
+    await asyncio.to_thread(token_budget.count_tokens, "warmup")
+    # Portada renderizada y comprimida antes de la primera visita
+    refresh_landing_page()
+    await asyncio.to_thread(static_assets.load_manifest)
+    job_queue.worker_pool.start()
+    app.state.session_watchdog = asyncio.create_task(session_leak_watchdog())
+    app.state.storage_maintenance = asyncio.create_task(storage_maintenance_loop())
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    app.state.session_watchdog.cancel()
+    app.state.storage_maintenance.cancel()
+    await job_queue.worker_pool.stop()
+    await gemini.close()
+    anonymizer.shutdown_pool()
+    images.shutdown_pool()
+    tts.shutdown_pool()
+    await async_engine.dispose()
+
+
 # =========================================================================
 # 3. ENDPOINTS API (Rutas)
 # =========================================================================
@@ -231,12 +519,16 @@ async def create_service(
     description: str = Form(None),
     include_image_analysis: bool = Form(False),
     include_tts_addon: bool = Form(False),
+    has_legal_consent: bool = Form(False),
     developer_bypass_key: str = Form(None),
+    stream: bool = Form(False),
     clinical_file: Optional[UploadFile] = File(None)
 ):
    
     if service_level not in TIERS:
         raise HTTPException(status_code=400, detail="Nivel de servicio no válido.")
+    if not has_legal_consent:
+        raise HTTPException(status_code=400, detail="Se requiere consentimiento legal")
        
     tier_info = TIERS[service_level]
    
@@ -255,22 +547,70 @@ async def create_service(
         if include_image_analysis and clinical_file:
             prompt_instruction += " " + ADDONS["image_analysis"]["instruction_boost"]
        
-        prompt = description if description else "Caso clínico no especificado. Análisis genérico de salud preventiva."
+        # La descripción se de-identifica (patrones + diccionarios PHI) antes de llegar al modelo
+        prompt = anonymizer.redact_text(description) if description else "Caso clínico no especificado. Análisis genérico de salud preventiva."
        
         # Preparar la data de la imagen para la llamada multimodal
-        image_data_base64 = None
+        image_data = None
         if clinical_file and clinical_file.file:
-            # Leer el contenido del archivo si existe (necesario para el bypass multimodal)
-            file_contents = await clinical_file.read()
-            # Codificar la imagen para el envío a Gemini (simulación: base64 en latin1)
-            image_data_base64 = base64.b64encode(file_contents).decode('latin1')
+            # Volcado por bloques con límite de tamaño; se carga una sola copia que llega intacta a Part.from_bytes
+            upload = await spool_upload(clinical_file)
+            try:
+                image_data = await asyncio.to_thread(upload.read_bytes)
+            finally:
+                upload.cleanup()
            
-        # Ejecutar análisis con la instrucción de tokens del nivel seleccionado
-        analysis_result = await call_gemini_api(prompt, prompt_instruction, image_data=image_data_base64)
         file_info = clinical_file.filename if clinical_file else None
        
+        # Límites de tokens del nivel (entrada y salida) aplicados en la llamada al modelo
+        budget = tier_budget(service_level, bool(include_image_analysis and clinical_file))
+
         # En el bypass, el audio se considera 'incluido' si se solicitó O si el nivel lo incluye
         tts_included_in_fulfillment = include_tts_addon or is_tts_included
+
+        # 1.3. MODO STREAMING (SSE): el texto llega al navegador a medida que se genera
+        if stream:
+            async def event_stream():
+                yield stream_hub.format_sse("meta", {
+                    "status": "success",
+                    "payment_method": "Bypass (Gratuito)",
+                    "fulfillment": {
+                        "user_id": user_id,
+                        "service_level": service_level,
+                        "file_info": file_info,
+                        "max_time_min": tier_info["max_time_min"],
+                        "tts_included": tts_included_in_fulfillment
+                    }
+                })
+                chunks = []
+                usage: Dict[str, Any] = {}
+                try:
+                    async for text in stream_gemini_api(prompt, prompt_instruction, image_data=image_data,
+                                                        budget=budget, usage=usage):
+                        chunks.append(text)
+                        yield stream_hub.format_sse("chunk", {"text": text})
+                except Exception as e:
+                    print(f"Error en streaming con Gemini: {e}")
+                    yield stream_hub.format_sse("error", {
+                        "analysis_status": "error",
+                        "reason": f"Error al generar el análisis en streaming: {e}",
+                        "prompt_used": prompt
+                    })
+                    return
+                yield stream_hub.format_sse("done", with_tts_token(
+                    {"analysis_status": "success", "analysis_text": "".join(chunks), "usage": usage},
+                    tts_included_in_fulfillment,
+                ))
+
+            return StreamingResponse(
+                event_stream(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        # Ejecutar análisis con la instrucción de tokens del nivel seleccionado
+        analysis_result = await call_gemini_api(prompt, prompt_instruction, image_data=image_data, budget=budget)
+        analysis_result = with_tts_token(analysis_result, tts_included_in_fulfillment)
        
         return {
             "status": "success",
@@ -335,66 +675,416 @@ async def create_service(
         "description_snippet": description[:100] if description else "N/A",
         "image_analysis": "true" if include_image_analysis else "false",
         "tts_audio": "true" if tts_included_in_metadata else "false", # Bandera real para fulfillment
-        "file_name": clinical_file.filename if clinical_file else "No File"
+        "file_name": clinical_file.filename if clinical_file else "No File",
+        # El caso se crea en el webhook: el consentimiento viaja en el metadata de la sesión
+        "has_legal_consent": "true" if has_legal_consent else "false"
     }
 
     return create_stripe_checkout_session(total_price, "Servicio Clínico IA", metadata, line_items)
 
 
+async def process_stripe_event(job_id: int, payload: Dict[str, Any]):
+    """
+    Etapa 2 del webhook ("process"): se ejecuta en la cola, fuera de la petición de Stripe.
+    Despacha el evento ya verificado y encola el cumplimiento si el pago está confirmado.
+    """
+    event = payload["event"]
+
+    # MANEJAR EL EVENTO PRINCIPAL
+    if event['type'] == 'checkout.session.completed':
+        session = event['data']['object']
+       
+        if session.get('payment_status') == 'paid':
+            print(f" Pago exitoso y verificado para Session ID: {session['id']}")
+           
+            # Encolar el cumplimiento en la cola persistente (sobrevive reinicios/deploys).
+            # El session_id es la clave de idempotencia: un reenvío de Stripe no duplica el trabajo.
+            job = await asyncio.to_thread(
+                job_queue.enqueue_job,
+                "fulfill_case",
+                {"session_id": session['id'], "metadata": dict(session.get('metadata') or {})},
+                session['id'],
+            )
+            job_queue.worker_pool.notify()
+            print(f" Cumplimiento encolado: Job ID {job['job_id']} (estado: {job['status']})")
+           
+        else:
+            print(f" Sesión completada, pero no pagada para Session ID: {session['id']}")
+
+    if event.get('id'):
+        await asyncio.to_thread(webhook_events.mark_processed, event['id'])
+    return {"event_id": event.get('id'), "event_type": event['type']}
+
+
+job_queue.register_handler("stripe_event", process_stripe_event)
+
+
 # --- RUTA WEBHOOK DE STRIPE (Fulfillment Seguro y CRÍTICO) ---
 @app.post("/stripe/webhook")
 async def stripe_webhook(request: Request):
     """
     Ruta para manejar eventos POST de Stripe (Webhooks).
     CRÍTICO: Verifica la firma y solo cumple el servicio con pago confirmado.
+    Etapa 1 ("verify + enqueue + ack"): los duplicados se responden antes de verificar la firma
+    y el procesamiento real ocurre en la cola (process_stripe_event).
     """
+    payload = await request.body()
+
+    # 0. DEDUPLICACIÓN RÁPIDA: LRU en memoria y, si no está, el registro persistente
+    peeked_event_id = webhook_events.peek_event_id(payload)
+    if peeked_event_id:
+        if peeked_event_id in webhook_events.recent_event_ids:
+            return JSONResponse({"message": "Duplicate event"}, status_code=200)
+        if await asyncio.to_thread(webhook_events.is_recorded, peeked_event_id):
+            webhook_events.recent_event_ids.add(peeked_event_id)
+            return JSONResponse({"message": "Duplicate event"}, status_code=200)
+
     if not STRIPE_WEBHOOK_SECRET:
         print(" STRIPE_WEBHOOK_SECRET no configurada. Saltando verificación de firma (RIESGO DE FRAUDE).")
        
-    payload = await request.body()
     sig_header = request.headers.get('stripe-signature')
     event = None
 
     # 1. VERIFICAR LA FIRMA DEL WEBHOOK
     try:
         if STRIPE_WEBHOOK_SECRET:
-             event = stripe.Webhook.construct_event(
+             stripe.Webhook.construct_event(
                  payload, sig_header, STRIPE_WEBHOOK_SECRET
              )
-        else:
-             event = json.loads(payload.decode('utf-8'))
+        # El payload ya verificado se guarda como JSON plano en la cola
+        event = json.loads(payload.decode('utf-8'))
              
     except Exception as e:
         print(f"Webhook Error: Error de verificación o carga: {e}")
         return JSONResponse({"message": "Invalid signature or payload"}, status_code=400)
-       
-    # 2. MANEJAR EL EVENTO PRINCIPAL
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-       
-        if session.get('payment_status') == 'paid':
-            print(f" Pago exitoso y verificado para Session ID: {session['id']}")
-           
-            # 3. Ejecutar la función de cumplimiento (ASÍNCRONA)
-            # Esta función desencadena el análisis de IA real.
-            asyncio.create_task(fulfill_case(session['metadata']))
-           
-        else:
-            print(f" Sesión completada, pero no pagada para Session ID: {session['id']}")
 
+    # 2. ENCOLAR (idempotente por event id) Y REGISTRAR EN EL LEDGER
+    # Se encola primero: si el proceso cae entre ambos pasos, la reentrega de Stripe no se pierde.
+    event_id = event.get('id')
+    await asyncio.to_thread(
+        job_queue.enqueue_job,
+        "stripe_event",
+        {"event": event},
+        f"evt:{event_id}" if event_id else None,
+    )
+    if event_id:
+        await asyncio.to_thread(webhook_events.record_event, event_id, event.get('type', ''))
+        webhook_events.recent_event_ids.add(event_id)
+    job_queue.worker_pool.notify()
+
+    # 3. ACK INMEDIATO
     return JSONResponse({"message": "Success"}, status_code=200)
 
+# --- ESTADO DE TRABAJOS DE CUMPLIMIENTO ---
+@app.get("/jobs/{public_id}")
+async def get_job_status(public_id: str):
+    job = await asyncio.to_thread(job_queue.get_job, public_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado.")
+    return job
+
+@app.get("/jobs/{public_id}/stream")
+async def stream_job(public_id: str):
+    """
+    Texto del análisis de cumplimiento en streaming (SSE). Si el trabajo ya terminó,
+    o se ejecuta en otro proceso, se emite el estado actual y se cierra el stream.
+    Se direcciona por el id opaco del trabajo, no por el secuencial.
+    """
+    job_key = await asyncio.to_thread(job_queue.get_job_key, public_id)
+
+    async def event_stream():
+        if job_key is None:
+            yield stream_hub.format_sse("error", {"reason": "Trabajo no encontrado."})
+            return
+        channel_key = fulfillment_channel(job_key["dedupe_key"]) if job_key["kind"] == "fulfill_case" else None
+        if channel_key and stream_hub.get_channel(channel_key) is not None:
+            async for event, data in stream_hub.subscribe(channel_key):
+                yield stream_hub.format_sse(event, data)
+            return
+        job = await asyncio.to_thread(job_queue.get_job, public_id)
+        if job["status"] == "completed":
+            yield stream_hub.format_sse("done", job["result"])
+        else:
+            yield stream_hub.format_sse("status", job)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# --- ESTADO DE CASOS (revalidación por ETag y push por SSE) ---
+# Los eventos se publican dentro del proceso; si el caso lo completa otro worker,
+# la relectura periódica de la DB lo detecta igualmente.
+CASE_EVENTS_RECHECK_SECONDS = 15
+# Tope de espera de la página de éxito: a que el webhook cree el caso y a que el caso termine
+CASE_EVENTS_CREATION_TIMEOUT_SECONDS = 120
+CASE_EVENTS_MAX_STREAM_SECONDS = 30 * 60
+# Espera a que el trabajo abra el canal de texto tras pasar el caso a 'processing'
+FULFILLMENT_STREAM_WAIT_SECONDS = 10
+# Formato de los id de sesión de Stripe Checkout (cs_test_… / cs_live_…)
+STRIPE_SESSION_ID_RE = re.compile(r"cs_(?:test|live)_[A-Za-z0-9]{10,250}")
+
+def _check_session_id(session_id: str):
+    if not STRIPE_SESSION_ID_RE.fullmatch(session_id):
+        raise HTTPException(status_code=404, detail="Caso no encontrado.")
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in tags or "*" in tags
+
+async def _authorize_case(case_id: int, user: User) -> str:
+    """
+    Solo el voluntario dueño del caso (o un admin) puede leerlo. Un caso ajeno responde
+    404 como uno inexistente, para no revelar qué ids existen. Devuelve el ETag actual.
+    """
+    access = await asyncio.to_thread(case_service.get_case_access, case_id)
+    if access is None or (user.role != "admin" and access["volunteer_id"] != user.id):
+        raise HTTPException(status_code=404, detail="Caso no encontrado.")
+    return access["etag"]
+
+def _case_response(request: Request, etag: Optional[str], load) -> Response:
+    """Estado y resultado del caso con revalidación: sin cambios responde 304 sin leer ai_result."""
+    if etag is None:
+        raise HTTPException(status_code=404, detail="Caso no encontrado.")
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    case = load()
+    if case is None:
+        raise HTTPException(status_code=404, detail="Caso no encontrado.")
+    headers["ETag"] = case_service.case_etag(case["case_id"], case["updated_at"])
+    return JSONResponse(case, headers=headers)
+
+@app.get("/cases/{case_id}")
+async def get_case_status(case_id: int, request: Request, current_user: User = Depends(get_current_user)):
+    etag = await _authorize_case(case_id, current_user)
+    return await asyncio.to_thread(_case_response, request, etag, lambda: case_service.get_case(case_id))
+
+@app.get("/cases/by-session/{session_id}")
+async def get_session_case_status(session_id: str, request: Request):
+    """Acceso anónimo (página de éxito de Stripe): el session_id de Stripe no es adivinable."""
+    _check_session_id(session_id)
+    etag = await asyncio.to_thread(case_service.get_session_case_etag, session_id)
+    return await asyncio.to_thread(_case_response, request, etag, lambda: case_service.get_case_by_session(session_id))
+
+async def _case_event_stream(key: str, load, wait_for_creation: bool):
+    """
+    Emite 'case' con el estado actual y con cada cambio, hasta un estado terminal.
+    La suscripción se abre antes de leer la DB para no perder una finalización intermedia.
+    La espera está acotada (creación del caso y duración total): al vencer se emite 'error' y se cierra.
+    """
+    started = time.monotonic()
+    with case_events.watch(key) as queue:
+        case = await asyncio.to_thread(load)
+        if case is None and not wait_for_creation:
+            yield stream_hub.format_sse("error", {"reason": "Caso no encontrado."})
+            return
+        last_version = None
+        while True:
+            if case is not None:
+                if case["updated_at"] != last_version:
+                    last_version = case["updated_at"]
+                    yield stream_hub.format_sse("case", case)
+                if case["status"] in case_events.TERMINAL_STATUSES:
+                    return
+            elapsed = time.monotonic() - started
+            if case is None and elapsed >= CASE_EVENTS_CREATION_TIMEOUT_SECONDS:
+                yield stream_hub.format_sse("error", {"reason": "Caso no encontrado."})
+                return
+            if elapsed >= CASE_EVENTS_MAX_STREAM_SECONDS:
+                yield stream_hub.format_sse("error", {"reason": "Tiempo de espera agotado. Recargue la página."})
+                return
+            try:
+                case = await asyncio.wait_for(queue.get(), timeout=CASE_EVENTS_RECHECK_SECONDS)
+            except asyncio.TimeoutError:
+                case = await asyncio.to_thread(load)
+                yield ": keepalive\n\n"
+
+def _case_event_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/cases/{case_id}/events")
+async def stream_case_events(case_id: int, current_user: User = Depends(get_current_user)):
+    await _authorize_case(case_id, current_user)
+    return _case_event_response(_case_event_stream(
+        case_events.case_key(case_id), lambda: case_service.get_case(case_id), wait_for_creation=False,
+    ))
+
+@app.get("/cases/by-session/{session_id}/events")
+async def stream_session_case_events(session_id: str):
+    """Para la página de éxito de Stripe: el caso aún puede no existir hasta que llegue el webhook."""
+    _check_session_id(session_id)
+    return _case_event_response(_case_event_stream(
+        case_events.session_key(session_id), lambda: case_service.get_case_by_session(session_id), wait_for_creation=True,
+    ))
+
+def _fulfillment_channel_ready(channel_key: str) -> bool:
+    # Un canal cerrado con error es de un intento anterior: se espera al del reintento
+    channel = stream_hub.get_channel(channel_key)
+    return channel is not None and not (channel.closed and channel.history and channel.history[-1][0] == "error")
+
+@app.get("/cases/by-session/{session_id}/stream")
+async def stream_session_analysis(session_id: str):
+    """
+    Texto del análisis pagado a medida que se genera (SSE 'chunk'), para la página de éxito.
+    El canal vive en el proceso que ejecuta el trabajo: si no aparece en FULFILLMENT_STREAM_WAIT_SECONDS
+    se emite 'unavailable' y el resultado llega igualmente por /cases/by-session/{id}/events.
+    """
+    _check_session_id(session_id)
+    channel_key = fulfillment_channel(session_id)
+
+    async def event_stream():
+        deadline = time.monotonic() + FULFILLMENT_STREAM_WAIT_SECONDS
+        while not _fulfillment_channel_ready(channel_key):
+            if time.monotonic() >= deadline:
+                yield stream_hub.format_sse("unavailable", {})
+                return
+            await asyncio.sleep(0.25)
+        async for event, data in stream_hub.subscribe(channel_key):
+            # El resultado final (y su estado) se entrega por los eventos del caso
+            yield stream_hub.format_sse(event, data if event == "chunk" else {})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# --- AUDIO DEL ANÁLISIS (add-on tts_audio) ---
+@app.post("/tts")
+async def create_tts_audio(text: str = Form(...), tts_token: str = Form(...)):
+    """
+    Arranca (una sola vez por análisis) la síntesis por fragmentos y responde de inmediato.
+    Si el audio ya está en caché solo se devuelve audio_url; si no, stream_url lo reproduce
+    mientras se sintetiza. El token se emite con el análisis solo si el add-on aplica.
+    """
+    if not tts.verify_token(text, tts_token):
+        raise HTTPException(status_code=403, detail="El audio no está incluido para este análisis.")
+    if not text.strip():
+        raise HTTPException(status_code=400, detail="El análisis no tiene texto que sintetizar.")
+    digest, cached = await tts.start_audio(text)
+    response = {"audio_url": f"/tts/audio/{digest}", "media_type": tts.media_type(), "cached": cached}
+    if not cached:
+        response["stream_url"] = f"/tts/stream/{digest}"
+    return response
+
+@app.get("/tts/stream/{digest}")
+async def stream_tts_audio(digest: str, request: Request):
+    """Audio en orden a medida que se sintetiza cada fragmento; si ya terminó, el archivo cacheado."""
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=404, detail="Audio no encontrado.")
+    # Se toma el render una sola vez: si termina antes de empezar la respuesta se sigue usando este
+    render = tts.get_render(digest)
+    if render is not None:
+        return StreamingResponse(
+            tts.stream_audio(render),
+            media_type=tts.media_type(),
+            headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"}
+        )
+    return tts.audio_response(request, digest)
+
+@app.get("/tts/audio/{digest}")
+async def get_tts_audio(digest: str, request: Request):
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=404, detail="Audio no encontrado.")
+    return tts.audio_response(request, digest)
+
+# --- SALUD DE LA BASE DE DATOS (gauges del pool de conexiones) ---
+@app.get("/health/db")
+async def health_db():
+    status = await asyncio.to_thread(pool_status)
+    return JSONResponse(status, status_code=200 if status["ok"] else 503)
+
+# --- MÉTRICAS DEL CLIENTE GEMINI (espera en cola vs. tiempo de modelo) ---
+@app.get("/metrics/gemini")
+async def gemini_metrics():
+    return gemini.metrics.snapshot()
+
+@app.get("/metrics/analysis-cache")
+async def analysis_cache_metrics():
+    return analysis_cache.snapshot()
+
+@app.get("/metrics/images")
+async def image_metrics():
+    return images.snapshot()
+
+@app.get("/metrics/blob-store")
+async def blob_store_metrics():
+    return blob_store.snapshot()
+
+@app.get("/metrics/tts")
+async def tts_metrics():
+    return tts.snapshot()
+
 # --- RUTAS DE REDIRECCIÓN Y PRINCIPAL (Mantenidas y actualizadas) ---
 
 @app.get("/stripe/success", response_class=HTMLResponse)
 async def stripe_success(session_id: str):
+    events_url = f"/cases/by-session/{quote(session_id, safe='')}/events"
+    analysis_stream_url = f"/cases/by-session/{quote(session_id, safe='')}/stream"
     return HTMLResponse(f"""
         <body style="font-family: 'Inter', sans-serif; text-align: center; padding: 50px; background: #e0f2f1;">
             <div style="background: white; padding: 40px; border-radius: 12px; max-width: 600px; margin: auto; box-shadow: 0 4px 6px rgba(0,0,0,0.1);">
                 <h1 style="color: #059669;">¡Pago Recibido y Verificado!</h1>
-                <p>Su pago ha sido **verificado por nuestro Webhook seguro**. El análisis de IA (controlado por tokens) se está ejecutando AHORA de forma asíncrona. Estará listo en breve.</p>
+                <p>Su pago ha sido **verificado por nuestro Webhook seguro**. El análisis de IA (controlado por tokens) se está ejecutando AHORA de forma asíncrona. Aparecerá aquí en cuanto esté listo.</p>
+                <p id="case-status" style="margin-top: 20px; font-weight: bold; color: #047857;">Esperando la confirmación del pago...</p>
+                <div id="case-result" style="display: none; margin-top: 20px; text-align: left; white-space: pre-wrap; font-size: 14px; background: #f0fdf4; padding: 16px; border-radius: 8px;"></div>
                 <p style="margin-top: 20px;"><a href="{RENDER_APP_URL}" style="color: #10b981; text-decoration: none; font-weight: bold;">Volver a la plataforma</a></p>
             </div>
+            <script>
+                // Push del servidor (SSE) al completarse el caso: sin sondeo ni temporizadores
+                const source = new EventSource({json.dumps(events_url)});
+                let analysisStream = null;
+                const closeAnalysisStream = () => {{
+                    if (analysisStream) {{ analysisStream.close(); analysisStream = null; }}
+                }};
+                // Texto progresivo del análisis (SSE 'chunk') mientras el caso está en curso
+                const openAnalysisStream = () => {{
+                    if (analysisStream) return;
+                    const result = document.getElementById("case-result");
+                    result.textContent = "";
+                    analysisStream = new EventSource({json.dumps(analysis_stream_url)});
+                    analysisStream.addEventListener("chunk", (event) => {{
+                        result.style.display = "block";
+                        result.textContent += JSON.parse(event.data).text;
+                    }});
+                    for (const name of ["done", "error", "unavailable"]) {{
+                        analysisStream.addEventListener(name, (event) => {{ if (event.data) closeAnalysisStream(); }});
+                    }}
+                }};
+                source.addEventListener("case", (event) => {{
+                    const data = JSON.parse(event.data);
+                    const status = document.getElementById("case-status");
+                    const result = document.getElementById("case-result");
+                    if (data.status === "completed" || data.status === "error") {{
+                        source.close();
+                        closeAnalysisStream();
+                        status.textContent = data.status === "completed" ? "Análisis listo." : "No se pudo completar el análisis.";
+                        result.textContent = data.ai_result || "";
+                        result.style.display = "block";
+                    }} else if (data.status === "retrying") {{
+                        closeAnalysisStream();
+                        status.textContent = "El análisis falló temporalmente. Reintentando...";
+                    }} else {{
+                        status.textContent = "Pago confirmado. Análisis en curso...";
+                        openAnalysisStream();
+                    }}
+                }});
+                // El servidor acota la espera: su evento 'error' trae un motivo y no se reconecta
+                source.addEventListener("error", (event) => {{
+                    if (!event.data) return;
+                    source.close();
+                    document.getElementById("case-status").textContent = JSON.parse(event.data).reason;
+                }});
+            </script>
         </body>
     """)
 
@@ -411,9 +1101,8 @@ async def stripe_cancel():
     """)
 
 # --- RUTA PRINCIPAL (HTML) ---
-@app.get("/", response_class=HTMLResponse)
-async def serve_frontend():
-   
+def render_landing_page() -> str:
+    """Construye el HTML de la portada a partir de TIERS/ADDONS (se ejecuta una vez, no por petición)."""
     tier_html = ""
     for level, data in TIERS.items():
         tasks = "".join(f'<li class="flex items-center text-xs text-gray-600"><svg class="h-4 w-4 text-emerald-500 mr-1" fill="none" viewBox="0 0 24 24" stroke="currentColor"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M5 13l4 4L19 7"/></svg>{task}</li>' for task in data['base_tasks'])
@@ -446,6 +1135,24 @@ async def serve_frontend():
     rendered_html = rendered_html.replace("{ADDONS_JSON}", json.dumps(ADDONS))
    
     return rendered_html
+
+
+# Portada precalculada: bytes + variantes gzip/br + ETag. Se regenera con refresh_landing_page()
+_landing_page: Optional[PrecompressedBody] = None
+
+
+def refresh_landing_page() -> PrecompressedBody:
+    """Vuelve a renderizar la portada (llamar si cambian TIERS, ADDONS o las claves públicas)."""
+    global _landing_page
+    _landing_page = PrecompressedBody(render_landing_page().encode("utf-8"), "text/html; charset=utf-8")
+    return _landing_page
+
+
+@app.get("/", response_class=HTMLResponse)
+async def serve_frontend(request: Request):
+    # ETag/Last-Modified: el navegador revalida y recibe 304 sin cuerpo
+    page = _landing_page or refresh_landing_page()
+    return page.response(request)
    
 # =========================================================================
 # 4. TEMPLATE HTML (FRONTEND COMPLETO CON JS Y PRECIO DINÁMICO)
@@ -484,128 +1191,47 @@ HTML_TEMPLATE = """
         let currentAudio = null; // Para manejar la reproducción activa
 
         // =========================================================================
-        // UTILITIES DE AUDIO (Conversión PCM a WAV - MANTENIDO)
+        // AUDIO DEL ANÁLISIS (sintetizado y cacheado en el servidor: POST /tts)
         // =========================================================================
 
-        function base64ToArrayBuffer(base64) {
-            const binaryString = atob(base64);
-            const len = binaryString.length;
-            const bytes = new Uint8Array(len);
-            for (let i = 0; i < len; i++) {
-                bytes[i] = binaryString.charCodeAt(i);
-            }
-            return bytes.buffer;
-        }
-
-        function pcmToWav(pcm16, sampleRate) {
-            const buffer = new ArrayBuffer(44 + pcm16.length * 2);
-            const view = new DataView(buffer);
-            let offset = 0;
-
-            function writeString(str) {
-                for (let i = 0; i < str.length; i++) {
-                    view.setUint8(offset++, str.charCodeAt(i));
-                }
-            }
-
-            // RIFF chunk headers
-            writeString('RIFF');
-            view.setUint32(offset, 36 + pcm16.length * 2, true); offset += 4;
-            writeString('WAVE');
-            writeString('fmt ');
-            view.setUint32(offset, 16, true); offset += 4;
-            view.setUint16(offset, 1, true); offset += 2;
-            view.setUint16(offset, 1, true); offset += 2;
-            view.setUint32(offset, sampleRate, true); offset += 4;
-            view.setUint32(offset, sampleRate * 2, true); offset += 4;
-            view.setUint16(offset, 2, true); offset += 2;
-            view.setUint16(offset, 16, true); offset += 2;
-            writeString('data');
-            view.setUint32(offset, pcm16.length * 2, true); offset += 4;
-
-            // Write PCM data
-            for (let i = 0; i < pcm16.length; i++) {
-                view.setInt16(offset, pcm16[i], true);
-                offset += 2;
-            }
-
-            return new Blob([view], { type: 'audio/wav' });
-        }
+        // Texto y token del último análisis renderizado con el add-on de audio
+        let ttsRequest = null;
 
-        async function generateAndPlayAudio(text, buttonElement) {
+        async function generateAndPlayAudio(buttonElement) {
             if (currentAudio && !currentAudio.paused) {
                 currentAudio.pause();
                 currentAudio.currentTime = 0;
             }
+            if (!ttsRequest) return;
            
             const originalText = buttonElement.textContent;
             buttonElement.disabled = true;
             buttonElement.textContent = ' Generando Audio...';
-           
-            const GEMINI_TTS_MODEL = "gemini-2.5-flash-preview-tts";
-            const TTS_VOICE_NAME = "Kore";
-
-            // Se deja la clave vacía. NOTA: Esto fallará sin una clave de API válida en el frontend.
-            const apiKey = "";
-            const apiUrl = `https://generativelanguage.googleapis.com/v1beta/models/${GEMINI_TTS_MODEL}:generateContent?key=${apiKey}`;
-
-            const natural_speech_prompt = `Di de forma natural y profesional, omitiendo cualquier mención a la puntuación o símbolos, solo el texto principal: ${text}`;
-
-            const payload = {
-                contents: [{
-                    parts: [{ text: natural_speech_prompt }]
-                }],
-                generationConfig: {
-                    responseModalities: ["AUDIO"],
-                    speechConfig: {
-                        voiceConfig: {
-                            prebuiltVoiceConfig: { voiceName: TTS_VOICE_NAME }
-                        }
-                    }
-                },
-                model: GEMINI_TTS_MODEL
-            };
 
             try {
-                const response = await fetch(apiUrl, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
-
+                const formData = new FormData();
+                formData.append('text', ttsRequest.text);
+                formData.append('tts_token', ttsRequest.token);
+                const response = await fetch(`${RENDER_APP_URL}/tts`, { method: 'POST', body: formData });
                 const result = await response.json();
-                const candidate = result.candidates?.[0];
-                const part = candidate?.content?.parts?.find(p => p.inlineData && p.inlineData.mimeType.startsWith('audio/'));
-
-                if (!part || !part.inlineData.data) {
-                    throw new Error("No se pudo obtener el audio de la respuesta de Gemini.");
+                if (!response.ok) {
+                    throw new Error(result.detail || `Error ${response.status}`);
                 }
 
-                const audioData = part.inlineData.data;
-                const mimeType = part.inlineData.mimeType;
-                const rateMatch = mimeType.match(/rate=(\d+)/);
-                const sampleRate = rateMatch ? parseInt(rateMatch[1], 10) : 24000;
-
-                // 2. CONVERSIÓN DE PCM A WAV
-                const pcmData = base64ToArrayBuffer(audioData);
-                const pcm16 = new Int16Array(pcmData);
-                const wavBlob = pcmToWav(pcm16, sampleRate);
-                const audioUrl = URL.createObjectURL(wavBlob);
-
-                // 3. REPRODUCCIÓN
-                currentAudio = new Audio(audioUrl);
-                currentAudio.play();
+                // El audio en caché se sirve con Range: el navegador empieza a reproducir sin descargarlo entero
+                // Si aún se está sintetizando, stream_url entrega los fragmentos en orden (suena en ~2 s)
+                currentAudio = new Audio(`${RENDER_APP_URL}${result.stream_url || result.audio_url}`);
+                await currentAudio.play();
 
                 buttonElement.textContent = ' Escuchando...';
                 currentAudio.onended = () => {
                     buttonElement.textContent = ' Reproducir Análisis';
                     buttonElement.disabled = false;
-                    URL.revokeObjectURL(audioUrl);
                 };
 
             } catch (error) {
                 console.error("Error al generar o reproducir el audio TTS:", error);
-                buttonElement.textContent = ' Error de Audio (Auth Fallida)';
+                buttonElement.textContent = ' Error de Audio';
             } finally {
                 if (buttonElement.textContent !== ' Escuchando...') {
                     setTimeout(() => {
@@ -740,7 +1366,9 @@ HTML_TEMPLATE = """
                 // Flujo de éxito (Vía Bypass)
                 const analysisText = response.fulfillment.analysis_result?.analysis_text || '';
                 const maxTime = response.fulfillment.max_time_min;
-                const ttsIncluded = response.fulfillment.tts_included;
+                const ttsToken = response.fulfillment.analysis_result?.tts_token;
+                const ttsIncluded = response.fulfillment.tts_included && ttsToken;
+                ttsRequest = ttsIncluded ? { text: analysisText, token: ttsToken } : null;
                
                 // Dividir el análisis para separar la sección de "Tratamiento Hipotético"
                 // El backend ya asegura que el aviso en ROJO esté antes del tratamiento
@@ -774,7 +1402,7 @@ HTML_TEMPLATE = """
                             <p class="text-lg font-semibold text-emerald-700 mt-4 border-b pb-2 border-emerald-200 flex justify-between items-center">
                                 <span> Análisis Clínico del Ateneo Clínico IA:</span>
                                 ${ttsIncluded ? `
-                                    <button id="tts-btn" onclick="generateAndPlayAudio('${escapeHtml(analysisText)}', this)"
+                                    <button id="tts-btn" onclick="generateAndPlayAudio(this)"
                                                 class="bg-blue-500 hover:bg-blue-600 text-white text-sm font-bold py-1 px-3 rounded-lg shadow-md transition duration-150 ease-in-out flex items-center">
                                           Reproducir Análisis
                                     </button>
@@ -833,6 +1461,61 @@ HTML_TEMPLATE = """
             }
         }
 
+        // =========================================================================
+        // STREAMING (SSE) DEL ANÁLISIS - Render progresivo del texto
+        // =========================================================================
+
+        async function readEventStream(response, onEvent) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let separator;
+                while ((separator = buffer.indexOf('\\n\\n')) !== -1) {
+                    const rawEvent = buffer.slice(0, separator);
+                    buffer = buffer.slice(separator + 2);
+                    let eventName = 'message';
+                    let data = '';
+                    rawEvent.split('\\n').forEach(line => {
+                        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                        else if (line.startsWith('data:')) data += line.slice(5).trim();
+                    });
+                    onEvent(eventName, data ? JSON.parse(data) : null);
+                }
+            }
+        }
+
+        async function handleStreamResponse(response) {
+            const resultsDiv = document.getElementById('results-section');
+            let meta = null;
+            let streamedText = '';
+
+            await readEventStream(response, (eventName, data) => {
+                if (eventName === 'meta') {
+                    meta = data;
+                    resultsDiv.innerHTML = `
+                        <div class="bg-emerald-50 border border-emerald-400 text-emerald-800 p-6 rounded-xl mt-6 animate-fadeIn">
+                            <p class="font-extrabold text-xl mb-3"> Generando Análisis (Vía Bypass)...</p>
+                            <div class="bg-white p-4 rounded-lg border border-emerald-300 shadow-inner mt-2">
+                                <p id="stream-text" class="whitespace-pre-wrap text-gray-800 text-sm leading-relaxed"></p>
+                            </div>
+                        </div>
+                    `;
+                } else if (eventName === 'chunk') {
+                    streamedText += data.text;
+                    const target = document.getElementById('stream-text');
+                    if (target) target.textContent = streamedText;
+                } else if ((eventName === 'done' || eventName === 'error') && meta) {
+                    // Al finalizar se reutiliza el render completo (secciones, waiver y botón TTS)
+                    meta.fulfillment.analysis_result = data;
+                    handleResponse(meta);
+                }
+            });
+        }
+
         async function submitForm(event) {
             event.preventDefault();
             const form = event.target;
@@ -848,6 +1531,8 @@ HTML_TEMPLATE = """
 
             const formData = new FormData(form);
             if (!formData.has('user_id')) { formData.append('user_id', DEMO_USER_ID); }
+            // En el flujo de bypass el análisis se recibe en streaming (SSE)
+            if (formData.get('developer_bypass_key')) { formData.append('stream', 'true'); }
            
             // Validar consentimiento legal
             const consentChecked = form.querySelector('#has_legal_consent').checked;
@@ -867,6 +1552,12 @@ HTML_TEMPLATE = """
                     body: formData
                 });
 
+                const contentType = response.headers.get('content-type') || '';
+                if (response.ok && contentType.startsWith('text/event-stream')) {
+                    await handleStreamResponse(response);
+                    return;
+                }
+
                 const data = await response.json();
                
                 if (!response.ok) {
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 import datetime
@@ -12,6 +12,7 @@ class User(Base):
     password = Column(String) 
     full_name = Column(String, nullable=True)
     role = Column(String, default="volunteer")
+    waiver_signed = Column(Boolean, nullable=True, default=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     cases = relationship("Case", back_populates="volunteer")
@@ -23,17 +24,71 @@ class Case(Base):
     
     title = Column(String)
     description = Column(Text)
-    file_path = Column(String, nullable=True)
+    # Ruta del blob anonimizado en BLOB_STORE_DIR; varios casos pueden compartirlo (refcount)
+    file_path = Column(String, nullable=True, index=True)
     
     status = Column(String, default="pending") 
     is_paid = Column(Boolean, default=False)
     price_paid = Column(Integer, default=50) 
-    stripe_session_id = Column(String, nullable=True)
+    # Único: clave de idempotencia del cumplimiento (un pago de Stripe = un caso)
+    stripe_session_id = Column(String, nullable=True, unique=True, index=True)
     has_legal_consent = Column(Boolean, default=False)
 
     ai_result = Column(Text, nullable=True) 
+    # Consumo del análisis según el modelo (para acotar coste y latencia por nivel)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
 
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow)
     
     volunteer = relationship("User", back_populates="cases")
+
+    # Índices compuestos para la paginación keyset del panel admin (filtro + orden por fecha)
+    __table_args__ = (
+        Index("ix_cases_status_created_at", "status", "created_at"),
+        Index("ix_cases_volunteer_id_created_at", "volunteer_id", "created_at"),
+    )
+
+class FulfillmentJob(Base):
+    """Cola persistente de trabajos de cumplimiento (reemplaza asyncio.create_task)."""
+    __tablename__ = "fulfillment_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    # Identificador opaco expuesto en /jobs/{public_id} (el id secuencial es enumerable)
+    public_id = Column(String, unique=True, index=True, nullable=True)
+    kind = Column(String, index=True)
+    # Clave de idempotencia (ej. el session_id de Stripe). Un mismo pago = un solo trabajo.
+    dedupe_key = Column(String, unique=True, nullable=True)
+    payload = Column(Text)
+
+    status = Column(String, default="pending", index=True)  # pending | running | completed | failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_after = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    locked_by = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+
+    last_error = Column(Text, nullable=True)
+    result = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class AnalysisCacheEntry(Base):
+    """Nivel compartido (entre workers) de la caché de análisis direccionada por contenido."""
+    __tablename__ = "analysis_cache"
+    key = Column(String(64), primary_key=True)  # SHA-256 hex
+    result = Column(Text)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    expires_at = Column(DateTime, index=True)
+
+class WebhookEvent(Base):
+    """Registro de eventos de Stripe ya recibidos (deduplicación de reentregas)."""
+    __tablename__ = "webhook_events"
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String, unique=True, index=True)
+    event_type = Column(String)
+    status = Column(String, default="received")  # received | processed
+    received_at = Column(DateTime, default=datetime.datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
@@ -1,9 +1,17 @@
-from fastapi import APIRouter, Header, HTTPException, Depends
-from sqlalchemy.orm import Session
-from database import get_db
+import base64
+import csv
+import datetime
+import io
+import json
+import zlib
+from fastapi import APIRouter, Header, HTTPException, Depends, Query, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db, session_scope
 from models import Case, User
 from config import ADMIN_BYPASS_KEY
-from typing import List
+from typing import List, Optional
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
@@ -13,19 +21,183 @@ async def admin_required(x_admin_key: str = Header(...)):
         raise HTTPException(status_code=403, detail="Acceso Prohibido: Clave de Administrador incorrecta.")
     return True
 
+# --- PAGINACIÓN KEYSET ---
+# El cursor es opaco para el cliente: codifica (created_at, id) de la última fila entregada.
+# A diferencia de OFFSET, el costo de cada página no crece con la profundidad.
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(*values) -> str:
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime.datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(values, list) or len(values) != size:
+            raise ValueError("cursor con formato inesperado")
+        return values
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido.")
+
+def _set_next_cursor(response: Response, rows: list, limit: int, key):
+    """Si la página vino llena, expone el cursor de la siguiente en la cabecera X-Next-Cursor."""
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(*key(rows[limit - 1]))
+
+def _filter_cases(query, status: Optional[str], volunteer_id: Optional[int],
+                  created_from: Optional[datetime.datetime], created_to: Optional[datetime.datetime]):
+    """Filtros comunes del listado y la exportación de casos."""
+    if status:
+        query = query.where(Case.status == status)
+    if volunteer_id is not None:
+        query = query.where(Case.volunteer_id == volunteer_id)
+    if created_from:
+        query = query.where(Case.created_at >= created_from)
+    if created_to:
+        query = query.where(Case.created_at < created_to)
+    return query
+
+# --- EXPORTACIÓN EN STREAMING ---
+# Filas que el driver trae por viaje (cursor del lado del servidor en Postgres)
+EXPORT_BATCH_ROWS = 1000
+# Se agrupan líneas hasta ~64 KB antes de emitir, para no enviar un chunk HTTP por fila
+EXPORT_FLUSH_BYTES = 64 * 1024
+EXPORT_COLUMNS = ("id", "volunteer_id", "title", "status", "is_paid", "price_paid",
+                  "stripe_session_id", "created_at", "updated_at", "ai_result")
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+def _iter_export_rows(query):
+    """
+    Recorre el resultado con yield_per + stream_results: la memoria depende del lote,
+    no del tamaño de la tabla. Es síncrono a propósito; StreamingResponse lo itera
+    en el threadpool, así que no bloquea el event loop.
+    """
+    with session_scope("admin_export") as db:
+        result = db.execute(query.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS))
+        for row in result:
+            yield [_export_value(v) for v in row]
+
+def _ndjson_lines(query):
+    for row in _iter_export_rows(query):
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+
+def _csv_lines(query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in _iter_export_rows(query):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+def _encode_chunks(lines, gzip_output: bool):
+    """Agrupa las líneas en bloques y, si se pidió, las comprime en gzip al vuelo."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if gzip_output else None
+    pending, size = [], 0
+    for line in lines:
+        data = line.encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        if size >= EXPORT_FLUSH_BYTES:
+            block = b"".join(pending)
+            pending, size = [], 0
+            block = compressor.compress(block) if compressor else block
+            if block:
+                yield block
+    block = b"".join(pending)
+    if compressor:
+        block = compressor.compress(block) + compressor.flush()
+    if block:
+        yield block
+
 # ------------------------------------------------------------------
 # --- ENDPOINTS DE ADMINISTRACIÓN ---
 # ------------------------------------------------------------------
 
 @router.get("/users", response_model=List[dict], dependencies=[Depends(admin_required)])
-def list_users(db: Session = Depends(get_db)):
-    """Lista todos los usuarios (requiere clave de admin)."""
-    users = db.query(User).all()
-    # Retorna un formato simple (deberías usar Pydantic Models)
-    return [{"id": u.id, "email": u.email, "role": u.role} for u in users]
+async def list_users(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    role: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Lista usuarios paginando por id (requiere clave de admin).
+    Solo se cargan las columnas mostradas; la siguiente página se pide con ?cursor=<X-Next-Cursor>.
+    """
+    query = select(User.id, User.email, User.role)
+    if role:
+        query = query.where(User.role == role)
+    if cursor:
+        (last_id,) = decode_cursor(cursor, 1)
+        query = query.where(User.id > last_id)
+    # Se pide una fila extra para saber si existe otra página sin hacer COUNT(*)
+    rows = (await db.execute(query.order_by(User.id).limit(limit + 1))).all()
+    _set_next_cursor(response, rows, limit, key=lambda r: (r.id,))
+    return [{"id": r.id, "email": r.email, "role": r.role} for r in rows[:limit]]
 
 @router.get("/cases", response_model=List[dict], dependencies=[Depends(admin_required)])
-def list_cases(db: Session = Depends(get_db)):
-    """Lista todos los casos (requiere clave de admin)."""
-    cases = db.query(Case).all()
-    return [{"id": c.id, "title": c.title, "status": c.status, "paid": c.is_paid} for c in cases]
+async def list_cases(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    volunteer_id: Optional[int] = None,
+    created_from: Optional[datetime.datetime] = None,
+    created_to: Optional[datetime.datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Lista casos del más reciente al más antiguo (requiere clave de admin).
+    No carga description ni ai_result: solo id/title/status/paid. Los filtros por status o
+    volunteer_id usan los índices compuestos (status, created_at) y (volunteer_id, created_at).
+    """
+    query = select(Case.id, Case.title, Case.status, Case.is_paid, Case.created_at)
+    query = _filter_cases(query, status, volunteer_id, created_from, created_to)
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor, 2)
+        try:
+            last_created_at = datetime.datetime.fromisoformat(last_created_at)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Cursor de paginación inválido.")
+        query = query.where(tuple_(Case.created_at, Case.id) < (last_created_at, last_id))
+
+    query = query.order_by(Case.created_at.desc(), Case.id.desc()).limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    _set_next_cursor(response, rows, limit, key=lambda r: (r.created_at, r.id))
+    return [{"id": r.id, "title": r.title, "status": r.status, "paid": r.is_paid} for r in rows[:limit]]
+
+@router.get("/cases/export", dependencies=[Depends(admin_required)])
+def export_cases(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    gzip: bool = False,
+    status: Optional[str] = None,
+    volunteer_id: Optional[int] = None,
+    created_from: Optional[datetime.datetime] = None,
+    created_to: Optional[datetime.datetime] = None,
+):
+    """
+    Exporta todos los casos (incluido ai_result) en NDJSON o CSV, en streaming y con
+    memoria constante. ?gzip=true comprime la salida al vuelo.
+    """
+    query = select(*(getattr(Case, column) for column in EXPORT_COLUMNS))
+    query = _filter_cases(query, status, volunteer_id, created_from, created_to).order_by(Case.id)
+
+    if format == "csv":
+        lines, media_type, extension = _csv_lines(query), "text/csv; charset=utf-8", "csv"
+    else:
+        lines, media_type, extension = _ndjson_lines(query), "application/x-ndjson", "ndjson"
+
+    filename = f"cases-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.{extension}"
+    headers = {"Cache-Control": "no-store", "Content-Disposition": f'attachment; filename="{filename}"'}
+    if gzip:
+        # Compresión de transporte: el cliente (curl --compressed, navegador) la deshace
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(_encode_chunks(lines, gzip), media_type=media_type, headers=headers)
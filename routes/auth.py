@@ -1,15 +1,15 @@
 from fastapi import APIRouter, HTTPException, Depends, Header
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from models import User
 from pydantic import BaseModel
 import datetime
 from config import ADMIN_BYPASS_KEY # Importamos la clave de administrador desde config
+from utils import hash_password_async, verify_and_update_password # bcrypt en pool dedicado
 
 router = APIRouter(prefix="/auth", tags=["auth"])
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # =================================================================
 # SCHEMAS
@@ -27,44 +27,49 @@ class LoginUser(BaseModel):
 # =================================================================
 # FUNCIONES AUXILIARES
 # =================================================================
-def hash_password(password: str):
-    return pwd_context.hash(password)
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def check_credentials(db: AsyncSession, db_user: User, password: str) -> bool:
+    """Verifica la contraseña y re-hashea de forma transparente si el hash quedó obsoleto."""
+    if not db_user:
+        return False
+    is_valid, new_hash = await verify_and_update_password(password, db_user.password)
+    if is_valid and new_hash:
+        db_user.password = new_hash
+        await db.commit()
+    return is_valid
 
 # =================================================================
 # 1. RUTA DE REGISTRO
 # =================================================================
 @router.post("/register")
-def register(user: RegisterUser, db: Session = Depends(get_db)):
+async def register(user: RegisterUser, db: AsyncSession = Depends(get_async_db)):
     if not user.waiver_signed and user.role != 'admin': # Admin no necesita waiver
         raise HTTPException(status_code=400, detail="Debe aceptar el waiver legal.")
     
-    db_user = db.query(User).filter(User.email == user.email).first()
+    db_user = (await db.execute(select(User).where(User.email == user.email))).scalars().first()
     if db_user:
         raise HTTPException(status_code=400, detail="El correo ya está registrado.")
     
+    # bcrypt es CPU intensivo: se ejecuta en el pool dedicado, fuera del event loop
+    hashed = await hash_password_async(user.password)
     new_user = User(
         email=user.email,
-        hashed_password=hash_password(user.password),
+        password=hashed,
         role=user.role,
-        # Nota: Asume que 'waiver_signed' existe en el modelo User
         waiver_signed=user.waiver_signed,
         created_at=datetime.datetime.utcnow()
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return {"message": "Usuario registrado correctamente", "user_id": new_user.id}
 
 # =================================================================
 # 2. RUTA DE LOGIN ESTÁNDAR (Voluntario/Profesional)
 # =================================================================
 @router.post("/login")
-def login(user: LoginUser, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.email == user.email).first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+async def login(user: LoginUser, db: AsyncSession = Depends(get_async_db)):
+    db_user = (await db.execute(select(User).where(User.email == user.email))).scalars().first()
+    if not await check_credentials(db, db_user, user.password):
         raise HTTPException(status_code=401, detail="Correo o contraseña incorrectos.")
     
     return {"message": "Login exitoso", "user_id": db_user.id, "role": db_user.role}
@@ -73,9 +78,9 @@ def login(user: LoginUser, db: Session = Depends(get_db)):
 # 3. RUTA DE LOGIN DE ADMINISTRADOR (CORREGIDA)
 # =================================================================
 @router.post("/admin")
-def admin_login(
+async def admin_login(
     user: LoginUser, 
-    db: Session = Depends(get_db), 
+    db: AsyncSession = Depends(get_async_db), 
     admin_secret_key: str = Header(None, alias="X-Admin-Key") # Captura el encabezado secreto
 ):
     # 💡 CORRECCIÓN: Usamos .strip() para sanear la clave de administrador
@@ -83,8 +88,8 @@ def admin_login(
         raise HTTPException(status_code=403, detail="Clave de administrador incorrecta o faltante.")
 
     # Verificación de credenciales estándar 
-    db_user = db.query(User).filter(User.email == user.email, User.role == "admin").first()
-    if not db_user or not verify_password(user.password, db_user.hashed_password):
+    db_user = (await db.execute(select(User).where(User.email == user.email, User.role == "admin"))).scalars().first()
+    if not await check_credentials(db, db_user, user.password):
         raise HTTPException(status_code=401, detail="Credenciales de Administrador incorrectas.")
 
     # Si pasa ambas verificaciones, el acceso es otorgado
@@ -98,8 +103,8 @@ def admin_login(
 # 4. RUTA DE VERIFICACIÓN DE WAIVER
 # =================================================================
 @router.get("/waiver-status/{user_id}")
-def waiver_status(user_id: int, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.id == user_id).first()
+async def waiver_status(user_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_user = (await db.execute(select(User).where(User.id == user_id))).scalars().first()
     if not db_user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     return {"waiver_signed": db_user.waiver_signed}
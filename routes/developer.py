@@ -1,13 +1,15 @@
 from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, Header
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from models import Case, User
 from services.ai_service import analyze_case
-from services.anonymizer import anonymize_file
+from services.anonymizer import detect_file_type
+from services.blob_store import store_anonymized
+from services.uploads import spool_upload
 from config import ADMIN_BYPASS_KEY
 import datetime
 import uuid
-import os
 
 router = APIRouter(prefix="/dev", tags=["developer"], include_in_schema=False)
 
@@ -20,7 +22,7 @@ async def process_case_free(
     description: str = Form(...),
     has_legal_consent: bool = Form(True), # Asumimos consentimiento para desarrollo
     file: UploadFile = File(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     # Requiere la clave de administrador para acceder a este endpoint
     x_admin_key: str = Header(...)
 ):
@@ -35,22 +37,17 @@ async def process_case_free(
         raise HTTPException(status_code=403, detail="Acceso denegado. Clave de administrador no válida.")
 
     # 2. Asignar a un usuario DEV fijo
-    user = db.query(User).filter(User.id == DEV_USER_ID).first()
+    user = (await db.execute(select(User).where(User.id == DEV_USER_ID))).scalars().first()
     if not user:
         raise HTTPException(status_code=500, detail=f"Usuario de desarrollo (ID {DEV_USER_ID}) no encontrado.")
 
     file_path = None
     ai_result = "PENDIENTE DE ANÁLISIS"
 
-    # 3. Manejo y Anonimización del Archivo
+    # 3. Manejo y Anonimización del Archivo (deduplicado por SHA-256 en el almacén de blobs)
     if file:
-        filename = f"{uuid.uuid4()}_{file.filename}"
-        temp_path = f"temp/{filename}"
-        os.makedirs("temp", exist_ok=True)
-        with open(temp_path, "wb") as f:
-            f.write(await file.read())
-        
-        file_path = anonymize_file(temp_path)
+        upload = await spool_upload(file)
+        file_path = await store_anonymized(upload, detect_file_type(file.filename))
     
     case_title = description[:50] if description else f"Caso DEV {user.email}-{datetime.datetime.utcnow().timestamp()}"
 
@@ -64,11 +61,11 @@ async def process_case_free(
         is_paid=True, # Acceso gratuito implica pago completado
         has_legal_consent=has_legal_consent,
         created_at=datetime.datetime.utcnow(),
-        stripe_session_id="DEV_BYPASS" # Marcador para indicar que no pasó por Stripe
+        stripe_session_id=f"DEV_BYPASS:{uuid.uuid4().hex}" # Marcador (único) para indicar que no pasó por Stripe
     )
     db.add(new_case)
-    db.commit()
-    db.refresh(new_case)
+    await db.commit()
+    await db.refresh(new_case)
 
     # 5. Procesar el Caso Inmediatamente con la IA
     try:
@@ -77,7 +74,7 @@ async def process_case_free(
         
         new_case.ai_result = ai_result
         new_case.status = "completed"
-        db.commit()
+        await db.commit()
         
         return {
             "message": "Caso procesado con éxito (ACCESO GRATUITO ILIMITADO)",
@@ -91,7 +88,7 @@ async def process_case_free(
         print(f"ERROR IA: Fallo al analizar el caso de Dev {new_case.id}: {str(e)}")
         new_case.status = "error"
         new_case.ai_result = f"Error de procesamiento de IA: {str(e)}" 
-        db.commit()
+        await db.commit()
         
         raise HTTPException(
             status_code=500, 
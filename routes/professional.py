@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Form, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
 from models import User
 from services.payment_service import create_payment_session
 from config import ADMIN_BYPASS_KEY, BASE_URL
@@ -10,10 +11,10 @@ import stripe
 router = APIRouter(prefix="/professional", tags=["professional"])
 
 # --- TAREA DE FONDO DE ACTIVACIÓN ---
-def process_professional_tool_activation(user_id: int, tool_name: str, db: Session):
+def process_professional_tool_activation(user_id: int, tool_name: str):
     # Aquí iría la lógica real para registrar el acceso profesional en la DB
+    # (abriendo su propia sesión con session_scope cuando la haya; hoy no consulta nada)
     print(f"INFO TAREA: Activando herramienta '{tool_name}' para Profesional {user_id} en DB.")
-    db.close()
 
 # ------------------------------------------------------------------
 # --- ENDPOINT 1: CREAR SESIÓN DE PAGO / BYPASS ---
@@ -24,9 +25,9 @@ async def activate_tool(
     user_id: int = Form(...),
     tool_name: str = Form(...),
     developer_bypass_key: str = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.id == user_id, User.role == "professional").first()
+    user = (await db.execute(select(User).where(User.id == user_id, User.role == "professional"))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado o no es profesional")
         
@@ -34,8 +35,7 @@ async def activate_tool(
     
     # LÓGICA DE BYPASS DE DESARROLLADOR
     if developer_bypass_key and developer_bypass_key == ADMIN_BYPASS_KEY:
-        db_session_for_task = get_db().__next__()
-        process_professional_tool_activation(user_id, tool_name, db_session_for_task)
+        process_professional_tool_activation(user_id, tool_name)
         return {"message": f"Herramienta {tool_name} activada por bypass. Lista para usar."}
         
     # FLUJO DE PAGO
@@ -61,7 +61,7 @@ async def activate_tool(
 @router.get("/tool-success")
 async def tool_success(
     session_id: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         session = stripe.checkout.Session.retrieve(session_id)
@@ -74,8 +74,7 @@ async def tool_success(
         tool_name = session.line_items.data[0].price.product.name.replace("Herramienta: ", "")
         
         # Activar el servicio en la DB
-        db_session_for_task = get_db().__next__()
-        process_professional_tool_activation(int(user_id), tool_name, db_session_for_task)
+        process_professional_tool_activation(int(user_id), tool_name)
 
         return {"message": f"Pago verificado. Herramienta '{tool_name}' activada."}
 
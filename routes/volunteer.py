@@ -1,34 +1,43 @@
 from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db, session_scope
 from models import Case, User
 from services.payment_service import create_payment_session
 from services.ai_service import analyze_case 
-from services.anonymizer import anonymize_file, detect_file_type 
+from services.anonymizer import detect_file_type 
+from services.blob_store import store_anonymized
+from services.uploads import spool_upload
+from services.case_events import publish_case
+from services.case_service import case_to_dict
 from config import ADMIN_BYPASS_KEY, BASE_URL
 import datetime
+import uuid
 import stripe 
 
 router = APIRouter(prefix="/volunteer", tags=["volunteer"])
 
 # --- LÓGICA DE PROCESAMIENTO ASÍNCRONO ---
-def process_case_task(case_id: int, db: Session):
-    case = db.query(Case).filter(Case.id == case_id).first()
-    if not case: return
-    try:
-        # Aquí se llama al servicio de IA
-        ai_result = analyze_case(case.description, case.file_path) 
-        case.ai_result = ai_result
-        case.status = "completed"
-        case.updated_at = datetime.datetime.utcnow()
-        db.commit()
-    except Exception as e:
-        case.status = "error"
-        case.ai_result = f"Error de IA: {str(e)}"
-        case.updated_at = datetime.datetime.utcnow()
-        db.commit()
-    finally:
-        db.close() 
+def process_case_task(case_id: int):
+    # La sesión se abre al ejecutar la tarea (no al encolarla) y siempre vuelve al pool
+    with session_scope("process_case_task") as db:
+        case = db.query(Case).filter(Case.id == case_id).first()
+        if not case: return
+        try:
+            # Aquí se llama al servicio de IA
+            ai_result = analyze_case(case.description, case.file_path) 
+            case.ai_result = ai_result
+            case.status = "completed"
+            case.updated_at = datetime.datetime.utcnow()
+            db.commit()
+        except Exception as e:
+            case.status = "error"
+            case.ai_result = f"Error de IA: {str(e)}"
+            case.updated_at = datetime.datetime.utcnow()
+            db.commit()
+        result, session_id = case_to_dict(case), case.stripe_session_id
+    # Push a los clientes suscritos (GET /cases/{id}/events) en lugar de que sondeen
+    publish_case(result, session_id)
 
 # ------------------------------------------------------------------
 # --- ENDPOINT 1: CREAR CASO Y GENERAR SESIÓN DE PAGO O BYPASS ---
@@ -42,9 +51,9 @@ async def create_case(
     has_legal_consent: bool = Form(...),
     developer_bypass_key: str = Form(None), 
     file: UploadFile = File(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.id == user_id, User.role == "volunteer").first()
+    user = (await db.execute(select(User).where(User.id == user_id, User.role == "volunteer"))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado o no es voluntario")
     if not has_legal_consent:
@@ -56,9 +65,10 @@ async def create_case(
 
     # Asumimos anonimización exitosa
     if file:
-        file_bytes = await file.read()
-        file_type = detect_file_type(file.filename)
-        # Necesitamos el ID del caso para nombrar el archivo. Hacemos un commit para obtenerlo.
+        # Se vuelca a disco por bloques (memoria acotada, límite de tamaño y SHA-256 en una pasada)
+        upload = await spool_upload(file)
+        # Almacén direccionado por contenido: si el mismo archivo ya se subió, no se re-anonimiza
+        file_path = await store_anonymized(upload, detect_file_type(file.filename))
         
     # Lógica de Bypass
     if developer_bypass_key and developer_bypass_key == ADMIN_BYPASS_KEY:
@@ -66,20 +76,14 @@ async def create_case(
             volunteer_id=user_id, title=case_title, description=description, 
             file_path=file_path, status="processing", is_paid=True, 
             price_paid=case_price, has_legal_consent=has_legal_consent,
-            stripe_session_id="DEVELOPER_FREE_ACCESS"
+            # Sufijo único: stripe_session_id tiene índice UNIQUE
+            stripe_session_id=f"DEVELOPER_FREE_ACCESS:{uuid.uuid4().hex}"
         )
         db.add(new_case)
-        db.commit()
-        db.refresh(new_case)
-        
-        # Si se usa bypass y hay archivo, anonimizar ahora
-        if file:
-            file_path = anonymize_file(file_bytes, file_type, new_case.id)
-            new_case.file_path = file_path
-            db.commit()
+        await db.commit()
+        await db.refresh(new_case)
 
-        db_session_for_task = get_db().__next__()
-        background_tasks.add_task(process_case_task, new_case.id, db_session_for_task)
+        background_tasks.add_task(process_case_task, new_case.id)
 
         return {
             "message": "Caso activado por bypass. Resultados en breve.",
@@ -94,14 +98,8 @@ async def create_case(
         has_legal_consent=has_legal_consent, is_paid=False
     )
     db.add(new_case)
-    db.commit()
-    db.refresh(new_case)
-
-    # Si hay archivo, anonimizar y actualizar la ruta después de tener el case_id
-    if file:
-        file_path = anonymize_file(file_bytes, file_type, new_case.id)
-        new_case.file_path = file_path
-        db.commit()
+    await db.commit()
+    await db.refresh(new_case)
     
     try:
         payment_session_data = create_payment_session(
@@ -114,10 +112,10 @@ async def create_case(
         if "error" in payment_session_data: raise Exception(payment_session_data["error"])
         
         new_case.stripe_session_id = payment_session_data.get("id")
-        db.commit()
+        await db.commit()
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=400, detail=f"Error en sesión de pago: {str(e)}")
 
     return {"message": "Redirigiendo a pago Stripe.", "payment_url": payment_session_data["url"]}
@@ -130,7 +128,7 @@ async def create_case(
 async def payment_success(
     session_id: str,
     background_tasks: BackgroundTasks, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     try:
         session = stripe.checkout.Session.retrieve(session_id)
@@ -142,7 +140,7 @@ async def payment_success(
         if not case_id:
             raise HTTPException(status_code=400, detail="Error: Metadata de caso ausente.")
 
-        case = db.query(Case).filter(Case.id == int(case_id)).first()
+        case = (await db.execute(select(Case).where(Case.id == int(case_id)))).scalars().first()
         
         if not case:
              raise HTTPException(status_code=404, detail="Caso no encontrado en DB.")
@@ -151,11 +149,10 @@ async def payment_success(
         case.is_paid = True
         case.status = "processing"
         case.updated_at = datetime.datetime.utcnow()
-        db.commit()
+        await db.commit()
         
         # Ejecutar la IA en segundo plano
-        db_session_for_task = get_db().__next__()
-        background_tasks.add_task(process_case_task, case.id, db_session_for_task)
+        background_tasks.add_task(process_case_task, case.id)
 
         return {"message": f"Pago verificado. Servicio ({case.id}) activado.", "case_id": case.id, "status": "processing"}
 
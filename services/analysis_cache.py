@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import delete, func, select
+
+from config import (
+    ANALYSIS_CACHE_DB_ENABLED,
+    ANALYSIS_CACHE_DB_MAX_ENTRIES,
+    ANALYSIS_CACHE_MAX_ENTRIES,
+    ANALYSIS_CACHE_TTL_SECONDS,
+)
+from database import session_scope
+from models import AnalysisCacheEntry
+
+
+def make_cache_key(model: str, system_instruction: str, prompt: str, image_data: Optional[bytes] = None,
+                   config_signature: str = "") -> str:
+    """
+    Clave direccionada por contenido. system_instruction ya incluye la token_instruction
+    del nivel y los boosts de ADDONS, así que dos niveles distintos nunca colisionan.
+    config_signature distingue los límites de generación (max_output_tokens, temperature).
+    """
+    digest = hashlib.sha256()
+    image_hash = hashlib.sha256(image_data).hexdigest() if image_data else ""
+    for field in (model, system_instruction, prompt, image_hash, config_signature):
+        digest.update(field.encode("utf-8"))
+        digest.update(b"\x00")  # separador: evita colisiones por concatenación
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Caché de resultados de análisis en dos niveles:
+    1. LRU en proceso con TTL (sin I/O).
+    2. Tabla analysis_cache en la base de datos (opcional), compartida entre workers.
+    """
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_MAX_ENTRIES,
+                 ttl_seconds: int = ANALYSIS_CACHE_TTL_SECONDS,
+                 db_enabled: bool = ANALYSIS_CACHE_DB_ENABLED,
+                 db_max_entries: int = ANALYSIS_CACHE_DB_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.db_max_entries = db_max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_enabled = db_enabled
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "evictions": 0,
+                      "db_evictions": 0}
+
+    # --- Nivel 1: LRU en memoria ---
+
+    def _memory_get(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _memory_set(self, key: str, value: Dict[str, Any]):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    # --- Nivel 2: base de datos (síncrono, se ejecuta vía asyncio.to_thread) ---
+
+    def _db_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with session_scope("analysis_cache") as db:
+            entry = db.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.key == key).first()
+            if entry is None:
+                return None
+            if entry.expires_at < datetime.datetime.utcnow():
+                db.delete(entry)
+                db.commit()
+                return None
+            entry.hits = (entry.hits or 0) + 1
+            db.commit()
+            return json.loads(entry.result)
+
+    def _db_set(self, key: str, value: Dict[str, Any]):
+        with session_scope("analysis_cache") as db:
+            now = datetime.datetime.utcnow()
+            db.merge(AnalysisCacheEntry(
+                key=key,
+                result=json.dumps(value),
+                hits=0,
+                created_at=now,
+                expires_at=now + datetime.timedelta(seconds=self.ttl_seconds),
+            ))
+            db.commit()
+
+    def prune_db(self) -> int:
+        """
+        Elimina las filas expiradas y, si aún se supera db_max_entries, las más próximas a
+        expirar. Se ejecuta en el mantenimiento periódico (main.storage_maintenance_loop).
+        """
+        if not self.db_enabled:
+            return 0
+        with session_scope("analysis_cache") as db:
+            removed = db.execute(
+                delete(AnalysisCacheEntry).where(AnalysisCacheEntry.expires_at < datetime.datetime.utcnow())
+            ).rowcount
+            excess = db.execute(select(func.count()).select_from(AnalysisCacheEntry)).scalar_one() - self.db_max_entries
+            if excess > 0:
+                oldest = select(AnalysisCacheEntry.key).order_by(AnalysisCacheEntry.expires_at).limit(excess)
+                removed += db.execute(
+                    delete(AnalysisCacheEntry).where(AnalysisCacheEntry.key.in_(oldest.scalar_subquery()))
+                ).rowcount
+            db.commit()
+        self.stats["db_evictions"] += removed
+        return removed
+
+    # --- API pública ---
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._memory_get(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+
+        if self.db_enabled:
+            try:
+                value = await asyncio.to_thread(self._db_get, key)
+            except Exception as e:
+                print(f"ERROR CACHÉ: Lectura del nivel DB fallida: {e}")
+                value = None
+            if value is not None:
+                self.stats["db_hits"] += 1
+                self._memory_set(key, value)
+                return value
+
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any]):
+        self._memory_set(key, value)
+        self.stats["stores"] += 1
+        if self.db_enabled:
+            try:
+                await asyncio.to_thread(self._db_set, key, value)
+            except Exception as e:
+                print(f"ERROR CACHÉ: Escritura del nivel DB fallida: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["memory_hits"] + self.stats["db_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["db_hits"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "db_enabled": self.db_enabled,
+            "db_max_entries": self.db_max_entries,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+analysis_cache = AnalysisCache()
@@ -1,17 +1,293 @@
-# MOCKUP
+import asyncio
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, Optional
+from xml.etree import ElementTree
+
+from config import ANONYMIZER_PAGE_CHARS, ANONYMIZER_WORKERS
+from services.phi_automaton import get_automaton, redact_terms
+
+# =========================================================================
+# 1. DETECCIÓN DE TIPO (bytes mágicos, no la extensión declarada)
+# =========================================================================
+
+_SNIFF_BYTES = 512
+
+
 def detect_file_type(file_name: str) -> str:
-    """Detecta el tipo de archivo (ej. pdf, docx, txt)."""
+    """Tipo según la extensión. Solo es una pista: sniff_file_type manda."""
     return file_name.split('.')[-1].lower()
 
-def anonymize_file(upload_file: bytes, file_type: str, case_id: int) -> str:
-    """Simula el proceso de anonimización y guarda el archivo."""
-    # 1. Crear un nombre de archivo seguro
-    safe_name = f"case_{case_id}_anon.pdf"
-    
-    # 2. Simular guardado
-    # with open(f"storage/{safe_name}", "wb") as f:
-    #     f.write(upload_file)
-
-    print(f"INFO: Archivo anonimizado y guardado como {safe_name}")
-    
-    return safe_name
+
+def sniff_file_type(path: str, hint: Optional[str] = None) -> str:
+    """Detecta pdf, docx, jpeg, png, dicom o txt a partir de la cabecera del archivo."""
+    with open(path, "rb") as f:
+        head = f.read(_SNIFF_BYTES)
+
+    if head.startswith(b"%PDF-"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(path) as archive:
+                if "word/document.xml" in archive.namelist():
+                    return "docx"
+        except zipfile.BadZipFile:
+            pass
+        return "zip"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[128:132] == b"DICM":
+        return "dicom"
+    try:
+        # Se recorta el final por si el bloque corta un carácter multibyte
+        head[:-4].decode("utf-8")
+        return "txt"
+    except UnicodeDecodeError:
+        return hint or "bin"
+
+
+# =========================================================================
+# 2. EXTRACCIÓN DE TEXTO POR PÁGINAS (en streaming)
+# =========================================================================
+
+def _iter_txt_pages(path: str) -> Iterator[str]:
+    """Agrupa líneas en 'páginas' de ~ANONYMIZER_PAGE_CHARS sin cortar ninguna línea."""
+    page, size = [], 0
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            page.append(line)
+            size += len(line)
+            if size >= ANONYMIZER_PAGE_CHARS:
+                yield "".join(page)
+                page, size = [], 0
+    if page:
+        yield "".join(page)
+
+
+def _iter_pdf_pages(path: str) -> Iterator[str]:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("pypdf no está instalado: no se puede extraer texto de PDF.")
+    reader = PdfReader(path)
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _iter_docx_pages(path: str) -> Iterator[str]:
+    """Recorre word/document.xml con iterparse, liberando cada párrafo tras leerlo."""
+    page, size = [], 0
+    with zipfile.ZipFile(path) as archive, archive.open("word/document.xml") as xml:
+        for _, element in ElementTree.iterparse(xml, events=("end",)):
+            if element.tag != f"{_W_NS}p":
+                continue
+            paragraph = "".join(node.text or "" for node in element.iter(f"{_W_NS}t")) + "\n"
+            element.clear()
+            page.append(paragraph)
+            size += len(paragraph)
+            if size >= ANONYMIZER_PAGE_CHARS:
+                yield "".join(page)
+                page, size = [], 0
+    if page:
+        yield "".join(page)
+
+
+_PAGE_READERS = {"txt": _iter_txt_pages, "pdf": _iter_pdf_pages, "docx": _iter_docx_pages}
+
+
+# =========================================================================
+# 3. REDACCIÓN DE PHI (un solo patrón precompilado, una pasada por página)
+# =========================================================================
+
+# Nombre propio: 1-4 palabras capitalizadas en la misma línea (sensible a mayúsculas)
+_NAME = r"(?-i:[A-ZÁÉÍÓÚÑ][a-záéíóúñü]+(?:[ \t]+(?:de[ \t]+(?:la[ \t]+)?|del[ \t]+)?[A-ZÁÉÍÓÚÑ][a-záéíóúñü]+){0,3})"
+_MONTHS = (r"(?:ene(?:ro)?|feb(?:rero)?|mar(?:zo)?|abr(?:il)?|may(?:o)?|jun(?:io)?|jul(?:io)?|ago(?:sto)?|"
+           r"sep(?:tiembre)?|set(?:iembre)?|oct(?:ubre)?|nov(?:iembre)?|dic(?:iembre)?)")
+
+# El orden importa: las alternativas más específicas van primero
+_PHI_PATTERNS = {
+    "EMAIL": r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+",
+    "NOMBRE": (r"(?:(?<=Paciente:\s)|(?<=Nombre:\s)|(?<=Sr\.\s)|(?<=Sra\.\s)|(?<=Dr\.\s)|(?<=Dra\.\s)|"
+               r"(?<=Don\s)|(?<=Doña\s))" + _NAME),
+    "FECHA": (r"\b(?:\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}|\d{4}-\d{2}-\d{2}|"
+              r"\d{1,2}\s+de\s+" + _MONTHS + r"\.?(?:\s+de\s+\d{4})?)\b"),
+    "ID": (r"\b(?:\d{8}[A-HJ-NP-TV-Z]|[XYZ]\d{7}[A-HJ-NP-TV-Z]|\d{3}-\d{2}-\d{4}|"
+           r"[A-Z]{4}\d{6}[HM][A-Z]{5}[A-Z\d]\d|(?:NHC|HC|MRN|Historia)[:#\s]*\d{4,})\b"),
+    "TELEFONO": (r"(?<![\w/])(?:\+\d{1,3}[\s.-]?)?(?:\(\d{2,4}\)[\s.-]?\d{3,4}[\s.-]?\d{4}|"
+                 r"\d{2,4}(?:[\s.-]\d{2,4}){2,4})(?![\w/])"),
+}
+
+_PHI_REGEX = re.compile(
+    "|".join(f"(?P<{label}>{pattern})" for label, pattern in _PHI_PATTERNS.items()),
+    re.IGNORECASE,
+)
+
+
+def redact_text(text: str, counts: Optional[Dict[str, int]] = None) -> str:
+    """
+    Sustituye cada PHI detectado por [ETIQUETA] y acumula el conteo por tipo en counts.
+    Primero los patrones estructurados (regex) y luego los diccionarios (autómata Aho-Corasick).
+    """
+    def replace(match: "re.Match[str]") -> str:
+        label = match.lastgroup
+        if counts is not None:
+            counts[label] = counts.get(label, 0) + 1
+        return f"[{label}]"
+
+    return redact_terms(get_automaton(), _PHI_REGEX.sub(replace, text), counts)
+
+
+# =========================================================================
+# 4. ARCHIVOS SIN TEXTO: IMÁGENES Y DICOM
+# =========================================================================
+
+class UnsupportedFileType(ValueError):
+    """Tipo de archivo que no se puede de-identificar (ZIP, binarios, DICOM sin pydicom)."""
+
+
+# Atributos DICOM que identifican al paciente, al personal o a la institución (se vacían).
+# Además se vacía todo elemento de tipo PN (nombre de persona) y se eliminan las etiquetas privadas.
+_DICOM_IDENTIFYING_TAGS = frozenset((
+    "PatientName", "PatientID", "PatientBirthDate", "PatientBirthTime", "PatientBirthName",
+    "PatientMotherBirthName", "OtherPatientIDs", "OtherPatientNames", "OtherPatientIDsSequence",
+    "IssuerOfPatientID", "PatientAddress", "PatientTelephoneNumbers", "MedicalRecordLocator",
+    "MilitaryRank", "BranchOfService", "CountryOfResidence", "RegionOfResidence", "EthnicGroup",
+    "ReferringPhysicianName", "ReferringPhysicianAddress", "ReferringPhysicianTelephoneNumbers",
+    "PerformingPhysicianName", "NameOfPhysiciansReadingStudy", "PhysiciansOfRecord", "OperatorsName",
+    "RequestingPhysician", "InstitutionName", "InstitutionAddress", "InstitutionalDepartmentName",
+    "StationName", "DeviceSerialNumber", "AccessionNumber", "StudyID", "AdmissionID",
+    "RequestAttributesSequence", "StudyDescription", "PatientComments", "AdditionalPatientHistory",
+))
+
+
+def _scrub_image(source_path: str, kind: str, dest_path: str):
+    """Recodifica JPEG/PNG en el mismo formato y tamaño, sin exif/icc/xmp ni chunks de texto."""
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as source:
+        image = ImageOps.exif_transpose(source)
+        if kind == "jpeg":
+            if image.mode not in ("RGB", "L", "CMYK"):
+                image = image.convert("RGB")
+            image.save(dest_path, format="JPEG", quality=95)
+        else:
+            image.save(dest_path, format="PNG", optimize=True)
+
+
+def _scrub_dicom(source_path: str, dest_path: str):
+    """Vacía los atributos identificativos (también dentro de secuencias) y quita las etiquetas privadas."""
+    try:
+        import pydicom
+    except ImportError:
+        raise UnsupportedFileType("pydicom no está instalado: no se puede de-identificar DICOM.")
+
+    dataset = pydicom.dcmread(source_path)
+
+    def blank(ds, element):
+        if element.keyword in _DICOM_IDENTIFYING_TAGS or element.VR == "PN":
+            element.value = [] if element.VR == "SQ" else ""
+
+    dataset.walk(blank)
+    dataset.remove_private_tags()
+    dataset.PatientIdentityRemoved = "YES"
+    dataset.save_as(dest_path)
+
+
+# =========================================================================
+# 5. PIPELINE DE ANONIMIZACIÓN (se ejecuta en un proceso del pool)
+# =========================================================================
+
+def anonymize_file(source_path: str, file_type: str, dest_path: str) -> Dict[str, Any]:
+    """
+    Escribe en dest_path la versión de-identificada de source_path, página a página
+    (memoria acotada a una página). Los documentos de texto se guardan como texto plano
+    redactado, con las páginas separadas por salto de página (\\f). Las imágenes se recodifican
+    sin metadatos y los DICOM pierden sus atributos identificativos; lo que no se puede
+    de-identificar (ZIP, binarios) se rechaza con UnsupportedFileType.
+    """
+    started = time.perf_counter()
+    kind = sniff_file_type(source_path, hint=file_type)
+    report: Dict[str, Any] = {"file_type": kind, "pages": 0, "redactions": {}}
+
+    reader = _PAGE_READERS.get(kind)
+    if kind in ("jpeg", "png"):
+        _scrub_image(source_path, kind, dest_path)
+    elif kind == "dicom":
+        _scrub_dicom(source_path, dest_path)
+    elif reader is None:
+        raise UnsupportedFileType(f"Tipo de archivo '{kind}' no admitido: no se puede anonimizar.")
+    else:
+        with open(dest_path, "w", encoding="utf-8") as out:
+            for page in reader(source_path):
+                if report["pages"]:
+                    out.write("\f")
+                out.write(redact_text(page, report["redactions"]))
+                report["pages"] += 1
+
+    report["seconds"] = round(time.perf_counter() - started, 4)
+    print(f"INFO: Archivo anonimizado ({kind}, {report['pages']} páginas, "
+          f"{sum(report['redactions'].values())} redacciones) y guardado como {dest_path}")
+    return report
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=ANONYMIZER_WORKERS)
+    return _process_pool
+
+
+async def anonymize_file_async(source_path: str, file_type: str, dest_path: str) -> Dict[str, Any]:
+    """Ejecuta anonymize_file en el pool de procesos: un PDF grande no bloquea el event loop ni el GIL."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_process_pool(), anonymize_file, source_path, file_type, dest_path)
+
+
+def shutdown_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+# =========================================================================
+# 6. BENCHMARK: python -m services.anonymizer [páginas]
+# =========================================================================
+
+_SAMPLE_PAGE = (
+    "Paciente: María José Fernández, DNI 12345678Z, NHC 0049123.\n"
+    "Fecha de ingreso 03/02/2024; control el 14 de marzo de 2024. Tel. +34 612 345 678.\n"
+    "Contacto: maria.fernandez@example.com. Atendida por la Dra. Lucía Gómez.\n"
+    "Refiere cefalea de 3 días, sin fiebre. TA 120/80, FC 72. Se solicita analítica.\n"
+) * 12
+
+
+def benchmark(pages: int = 500) -> Dict[str, Any]:
+    """Mide páginas/segundo (de ANONYMIZER_PAGE_CHARS) sobre un documento sintético con PHI."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "sample.txt")
+        with open(source, "w", encoding="utf-8") as f:
+            f.write(_SAMPLE_PAGE * pages)
+        report = anonymize_file(source, "txt", os.path.join(tmp, "sample.anon.txt"))
+
+    report["pages_per_second"] = round(report["pages"] / report["seconds"], 1) if report["seconds"] else None
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+
+    print(benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
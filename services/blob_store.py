@@ -0,0 +1,125 @@
+import asyncio
+import os
+import tempfile
+import time
+from typing import Any, Dict, Set
+
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from config import (
+    BLOB_GC_GRACE_SECONDS,
+    BLOB_STORE_DIR,
+    UPLOAD_TEMP_DIR,
+    UPLOAD_TEMP_MAX_AGE_SECONDS,
+)
+from database import session_scope
+from models import Case
+from services.anonymizer import UnsupportedFileType, anonymize_file_async
+from services.uploads import SpooledUpload
+
+# Un candado por digest: dos subidas simultáneas del mismo archivo anonimizan una sola vez
+_digest_locks: Dict[str, asyncio.Lock] = {}
+stats = {"stored": 0, "dedup_hits": 0, "gc_blobs_removed": 0, "gc_temp_removed": 0}
+
+
+def blob_path(digest: str) -> str:
+    """Ruta fragmentada por los primeros bytes del SHA-256: storage/blobs/ab/cd/abcd…"""
+    return os.path.join(BLOB_STORE_DIR, digest[:2], digest[2:4], digest)
+
+
+async def _anonymize_into_store(upload: SpooledUpload, file_type: str, final_path: str):
+    """Anonimiza (en el pool de procesos) a un temporal junto al destino y lo publica con un rename atómico."""
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(final_path))
+    os.close(fd)
+    try:
+        await anonymize_file_async(upload.path, file_type, partial_path)
+        os.replace(partial_path, final_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+
+
+async def store_anonymized(upload: SpooledUpload, file_type: str) -> str:
+    """
+    Devuelve la ruta del blob anonimizado para esta subida, usando como dirección
+    el SHA-256 del original. Si ya existe (mismo archivo subido antes), se reutiliza
+    sin volver a anonimizar. El temporal de la subida se elimina en ambos casos.
+    Un tipo que no se puede anonimizar se rechaza con 415.
+    """
+    final_path = blob_path(upload.sha256)
+    lock = _digest_locks.setdefault(upload.sha256, asyncio.Lock())
+    try:
+        async with lock:
+            if os.path.exists(final_path):
+                stats["dedup_hits"] += 1
+                # Refresca mtime: un blob recién reutilizado no debe caer en el GC antes del commit del caso
+                os.utime(final_path)
+                print(f"INFO: Adjunto deduplicado ({upload.sha256[:12]}…), se omite la anonimización.")
+            else:
+                try:
+                    await _anonymize_into_store(upload, file_type, final_path)
+                except UnsupportedFileType as e:
+                    raise HTTPException(status_code=415, detail=str(e))
+                stats["stored"] += 1
+    finally:
+        _digest_locks.pop(upload.sha256, None)
+        upload.cleanup()
+    return final_path
+
+
+# =========================================================================
+# RECOLECCIÓN DE BASURA (Case.file_path hace de contador de referencias)
+# =========================================================================
+
+def _referenced_paths() -> Set[str]:
+    with session_scope("blob_store") as db:
+        rows = db.execute(select(Case.file_path).where(Case.file_path.isnot(None)).distinct())
+        return {os.path.normpath(path) for (path,) in rows}
+
+
+def _remove_if_older(path: str, max_age: float, now: float) -> bool:
+    try:
+        if now - os.path.getmtime(path) < max_age:
+            return False
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def collect_garbage() -> Dict[str, int]:
+    """
+    Elimina (1) temporales de subida abandonados y (2) blobs sin ningún Case que los
+    referencie. Ambos solo pasado un margen de gracia, para no tocar subidas en curso
+    ni blobs cuyo caso aún no se ha confirmado en la DB.
+    """
+    now = time.time()
+    removed = {"temp": 0, "blobs": 0}
+
+    if os.path.isdir(UPLOAD_TEMP_DIR):
+        for entry in os.scandir(UPLOAD_TEMP_DIR):
+            if entry.is_file() and _remove_if_older(entry.path, UPLOAD_TEMP_MAX_AGE_SECONDS, now):
+                removed["temp"] += 1
+
+    if os.path.isdir(BLOB_STORE_DIR):
+        referenced = _referenced_paths()
+        for directory, _, files in os.walk(BLOB_STORE_DIR):
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.path.normpath(path) in referenced:
+                    continue
+                if _remove_if_older(path, BLOB_GC_GRACE_SECONDS, now):
+                    removed["blobs"] += 1
+
+    stats["gc_temp_removed"] += removed["temp"]
+    stats["gc_blobs_removed"] += removed["blobs"]
+    if any(removed.values()):
+        print(f"INFO: GC de adjuntos: {removed['blobs']} blobs huérfanos y {removed['temp']} temporales eliminados.")
+    return removed
+
+
+def snapshot() -> Dict[str, Any]:
+    return {**stats, "root": BLOB_STORE_DIR}
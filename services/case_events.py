@@ -0,0 +1,68 @@
+import asyncio
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Set
+
+# Estados tras los cuales un caso ya no cambia (el suscriptor recibe el último evento y se cierra)
+TERMINAL_STATUSES = ("completed", "error")
+
+# Suscriptores por clave ('case:<id>' o 'session:<stripe_session_id>')
+_watchers: Dict[str, Set[asyncio.Queue]] = {}
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def case_key(case_id: int) -> str:
+    return f"case:{case_id}"
+
+
+def session_key(session_id: str) -> str:
+    return f"session:{session_id}"
+
+
+@contextmanager
+def watch(key: str) -> Iterator[asyncio.Queue]:
+    """
+    Registra una cola que recibe cada cambio publicado para la clave. Se registra antes
+    de leer el estado en la DB, para no perder un cambio ocurrido entre la lectura y la espera.
+    """
+    global _loop
+    _loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    _watchers.setdefault(key, set()).add(queue)
+    try:
+        yield queue
+    finally:
+        queues = _watchers.get(key)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del _watchers[key]
+
+
+def _deliver(keys, case: Dict[str, Any]):
+    for key in keys:
+        for queue in _watchers.get(key, ()):
+            queue.put_nowait(case)
+
+
+def publish_case(case: Dict[str, Any], session_id: Optional[str] = None):
+    """
+    Notifica el nuevo estado de un caso a sus suscriptores. Se puede llamar desde el event
+    loop o desde un hilo (BackgroundTasks, asyncio.to_thread): las colas solo se tocan en el loop.
+    """
+    keys = [case_key(case["case_id"])]
+    if session_id:
+        keys.append(session_key(session_id))
+    if not any(key in _watchers for key in keys):
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is not None and running is _loop:
+        _deliver(keys, case)
+    elif _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_deliver, keys, case)
+
+
+def snapshot() -> Dict[str, Any]:
+    return {"keys": len(_watchers), "subscribers": sum(len(queues) for queues in _watchers.values())}
@@ -0,0 +1,146 @@
+import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import insert as generic_insert
+from sqlalchemy.exc import IntegrityError
+
+from database import engine, session_scope
+from models import Case, User
+
+
+def _insert_ignore_conflict(values: Dict[str, Any]):
+    """INSERT ... ON CONFLICT (stripe_session_id) DO NOTHING según el dialecto de la DB."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif engine.dialect.name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return generic_insert(Case).values(**values)
+    return insert(Case).values(**values).on_conflict_do_nothing(index_elements=[Case.stripe_session_id])
+
+
+def case_to_dict(case: Case) -> Dict[str, Any]:
+    return {
+        "case_id": case.id,
+        "status": case.status,
+        "is_paid": case.is_paid,
+        "ai_result": case.ai_result,
+        "updated_at": case.updated_at.isoformat() if case.updated_at else None,
+    }
+
+
+def upsert_paid_case(stripe_session_id: str, values: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Garantiza un único Case por sesión de Stripe (upsert idempotente).
+    - Si no existe, lo inserta como pagado y 'processing'.
+    - Si ya existe (reentrega del webhook o caso creado por /volunteer), lo marca pagado
+      sin tocar un resultado ya completado.
+    Devuelve el estado actual, para que el llamador omita la IA si ya está 'completed'.
+    """
+    with session_scope("case_service") as db:
+        now = datetime.datetime.utcnow()
+        volunteer_id = values.get("volunteer_id")
+        if volunteer_id is not None and not db.query(User.id).filter(User.id == volunteer_id).first():
+            # Usuarios demo del frontend (ej. 999) no existen: se evita violar la FK
+            volunteer_id = None
+
+        row = {
+            **values,
+            "volunteer_id": volunteer_id,
+            "stripe_session_id": stripe_session_id,
+            "status": "processing",
+            "is_paid": True,
+            "created_at": now,
+            "updated_at": now,
+        }
+        try:
+            db.execute(_insert_ignore_conflict(row))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+
+        case = db.query(Case).filter(Case.stripe_session_id == stripe_session_id).first()
+        if case.status != "completed" and (not case.is_paid or case.status != "processing"):
+            case.is_paid = True
+            case.status = "processing"
+            case.updated_at = now
+            db.commit()
+        return case_to_dict(case)
+
+
+def save_case_result(case_id: int, analysis_result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Persiste el resultado de la IA (ai_result, status, updated_at) en el caso. Un fallo queda
+    como 'retrying' (no terminal): la cola reintentará y solo mark_case_failed lo cierra.
+    """
+    with session_scope("case_service") as db:
+        case = db.query(Case).filter(Case.id == case_id).first()
+        if not case:
+            return None
+        if analysis_result.get("analysis_status") == "success" and analysis_result.get("analysis_text"):
+            case.ai_result = analysis_result.get("analysis_text")
+            case.status = "completed"
+        else:
+            case.ai_result = f"Error de IA: {analysis_result.get('reason') or 'respuesta vacía'}"
+            case.status = "retrying"
+        usage = analysis_result.get("usage") or {}
+        if usage.get("prompt_tokens") is not None:
+            case.prompt_tokens = usage["prompt_tokens"]
+            case.completion_tokens = usage.get("completion_tokens")
+        case.updated_at = datetime.datetime.utcnow()
+        db.commit()
+        return case_to_dict(case)
+
+
+def mark_case_failed(stripe_session_id: str, reason: str) -> Optional[Dict[str, Any]]:
+    """Marca 'error' (terminal) cuando la cola agotó los reintentos. No pisa un caso completado."""
+    with session_scope("case_service") as db:
+        case = db.query(Case).filter(Case.stripe_session_id == stripe_session_id).first()
+        if not case:
+            return None
+        if case.status != "completed":
+            case.status = "error"
+            case.ai_result = f"Error de IA: {reason}"
+            case.updated_at = datetime.datetime.utcnow()
+            db.commit()
+        return case_to_dict(case)
+
+
+def get_case(case_id: int) -> Optional[Dict[str, Any]]:
+    with session_scope("case_service") as db:
+        case = db.query(Case).filter(Case.id == case_id).first()
+        return case_to_dict(case) if case else None
+
+
+def get_case_by_session(stripe_session_id: str) -> Optional[Dict[str, Any]]:
+    with session_scope("case_service") as db:
+        case = db.query(Case).filter(Case.stripe_session_id == stripe_session_id).first()
+        return case_to_dict(case) if case else None
+
+
+def case_etag(case_id: int, updated_at: Optional[str]) -> str:
+    """ETag del caso a partir de updated_at (ISO): cambia con cada escritura del caso."""
+    return f'"{case_id}-{updated_at or 0}"'
+
+
+def get_case_access(case_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Dueño y ETag del caso leyendo solo volunteer_id y updated_at (no ai_result):
+    basta para autorizar y para responder 304 a una revalidación.
+    """
+    with session_scope("case_service") as db:
+        row = db.query(Case.volunteer_id, Case.updated_at).filter(Case.id == case_id).first()
+        if row is None:
+            return None
+        return {
+            "volunteer_id": row.volunteer_id,
+            "etag": case_etag(case_id, row.updated_at.isoformat() if row.updated_at else None),
+        }
+
+
+def get_session_case_etag(stripe_session_id: str) -> Optional[str]:
+    with session_scope("case_service") as db:
+        row = db.query(Case.id, Case.updated_at).filter(Case.stripe_session_id == stripe_session_id).first()
+        if row is None:
+            return None
+        return case_etag(row.id, row.updated_at.isoformat() if row.updated_at else None)
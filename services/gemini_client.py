@@ -0,0 +1,170 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import httpx
+from google import genai
+from google.genai import types
+
+from config import (
+    GEMINI_API_KEY,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_MAX_CONNECTIONS,
+    GEMINI_TIMEOUT_SECONDS,
+)
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# =========================================================================
+# 1. CLIENTE ÚNICO CON POOL DE CONEXIONES COMPARTIDO
+# =========================================================================
+
+# Un solo AsyncClient de httpx para todo el proceso: reutiliza conexiones keep-alive
+# en lugar de ocupar un hilo del threadpool por cada análisis en curso.
+_http_client: Optional[httpx.AsyncClient] = None
+gemini_client: Optional[genai.Client] = None
+
+if GEMINI_API_KEY:
+    try:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(GEMINI_TIMEOUT_SECONDS, connect=10.0),
+        )
+        gemini_client = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=types.HttpOptions(httpx_async_client=_http_client),
+        )
+    except Exception as e:
+        print(f"Error inicializando el cliente de Gemini: {e}")
+
+
+# =========================================================================
+# 2. CONCURRENCIA ACOTADA Y MÉTRICAS (espera en cola vs. tiempo de modelo)
+# =========================================================================
+
+class GeminiMetrics:
+    """Contadores en proceso para dimensionar GEMINI_MAX_CONCURRENCY por worker."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.model_time_total = 0.0
+        self.model_time_max = 0.0
+        self.first_chunk_total = 0.0
+        self.streams = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        completed = max(self.requests, 1)
+        return {
+            "max_concurrency": GEMINI_MAX_CONCURRENCY,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "queue_wait_avg_ms": round(self.queue_wait_total / completed * 1000, 1),
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 1),
+            "model_time_avg_ms": round(self.model_time_total / completed * 1000, 1),
+            "model_time_max_ms": round(self.model_time_max * 1000, 1),
+            "streams": self.streams,
+            "time_to_first_chunk_avg_ms": round(self.first_chunk_total / max(self.streams, 1) * 1000, 1),
+        }
+
+
+metrics = GeminiMetrics()
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    # Se crea de forma perezosa dentro del event loop de uvicorn
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return _semaphore
+
+
+@asynccontextmanager
+async def _model_slot():
+    """
+    Reserva un turno del semáforo por proceso y registra por separado el tiempo
+    esperando turno y el tiempo ocupado por el modelo.
+    """
+    if not gemini_client:
+        raise RuntimeError("GEMINI_API_KEY no configurada.")
+
+    semaphore = _get_semaphore()
+    queued_at = time.perf_counter()
+    metrics.waiting += 1
+    try:
+        await semaphore.acquire()
+    finally:
+        metrics.waiting -= 1
+
+    started_at = time.perf_counter()
+    wait = started_at - queued_at
+    metrics.queue_wait_total += wait
+    metrics.queue_wait_max = max(metrics.queue_wait_max, wait)
+    metrics.in_flight += 1
+    try:
+        yield started_at
+    except Exception:
+        metrics.errors += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        semaphore.release()
+        metrics.in_flight -= 1
+        metrics.requests += 1
+        metrics.model_time_total += elapsed
+        metrics.model_time_max = max(metrics.model_time_max, elapsed)
+
+
+async def generate_content(contents: Any, config: Any, model: str = GEMINI_MODEL):
+    """Llamada nativa asíncrona a Gemini (client.aio) limitada por el semáforo por proceso."""
+    async with _model_slot():
+        return await gemini_client.aio.models.generate_content(
+            model=model,
+            contents=contents,
+            config=config,
+        )
+
+
+async def generate_content_stream(contents: Any, config: Any, model: str = GEMINI_MODEL,
+                                  usage: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    """
+    Generación en streaming: produce fragmentos de texto a medida que llegan.
+    El turno del semáforo se mantiene hasta consumir el último fragmento.
+    Si se pasa usage, recibe el usage_metadata y finish_reason del último fragmento que los traiga.
+    """
+    async with _model_slot() as started_at:
+        stream = await gemini_client.aio.models.generate_content_stream(
+            model=model,
+            contents=contents,
+            config=config,
+        )
+        first_chunk = True
+        async for chunk in stream:
+            if first_chunk:
+                metrics.streams += 1
+                metrics.first_chunk_total += time.perf_counter() - started_at
+                first_chunk = False
+            if usage is not None:
+                if chunk.usage_metadata is not None:
+                    usage["usage_metadata"] = chunk.usage_metadata
+                if chunk.candidates and chunk.candidates[0].finish_reason:
+                    usage["finish_reason"] = chunk.candidates[0].finish_reason
+            if chunk.text:
+                yield chunk.text
+
+
+async def close():
+    """Cierra el pool de conexiones al apagar la aplicación."""
+    if _http_client is not None:
+        await _http_client.aclose()
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from config import (
+    IMAGE_DERIVED_DIR,
+    IMAGE_DERIVED_MAX_AGE_SECONDS,
+    IMAGE_MAX_DIMENSION,
+    IMAGE_OUTPUT_FORMAT,
+    IMAGE_QUALITY,
+    IMAGE_WORKERS,
+)
+
+# Formatos rasterizados que se preprocesan; PDF y HEIC se envían tal cual
+_RASTER_MIMES = ("image/jpeg", "image/png", "image/webp")
+_OUTPUT_MIMES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+stats = {"processed": 0, "derived_hits": 0, "failures": 0, "bytes_in": 0, "bytes_out": 0}
+
+# =========================================================================
+# 1. DETECCIÓN DEL MIME REAL (el nombre y el Content-Type del cliente no son fiables)
+# =========================================================================
+
+def sniff_mime(data: bytes) -> Optional[str]:
+    """MIME según los bytes mágicos, o None si Gemini no lo admite como dato inline."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:12] in (b"ftypheic", b"ftypheix", b"ftypmif1"):
+        return "image/heic"
+    if data.startswith(b"%PDF-"):
+        return "application/pdf"
+    return None
+
+
+# =========================================================================
+# 2. PREPROCESADO (se ejecuta en un proceso del pool)
+# =========================================================================
+
+# Metadatos que pueden llevar PHI (GPS, fecha, dispositivo, autor, comentarios)
+_METADATA_KEYS = ("exif", "icc_profile", "xmp", "XML:com.adobe.xmp", "comment", "photoshop")
+# Segmentos APP de JPEG sin metadatos: JFIF (APP0) y Adobe (APP14)
+_PLAIN_JPEG_SEGMENTS = ("APP0", "APP14")
+
+
+def _has_metadata(source) -> bool:
+    if any(key in source.info for key in _METADATA_KEYS):
+        return True
+    if getattr(source, "text", None):  # chunks tEXt/iTXt/zTXt de PNG
+        return True
+    return any(marker not in _PLAIN_JPEG_SEGMENTS for marker, _ in getattr(source, "applist", ()))
+
+
+def _preprocess(data: bytes, max_dimension: int, output_format: str, quality: int) -> bytes:
+    """
+    Orienta según EXIF, reduce al lado máximo y recodifica. La imagen se guarda sin
+    pasar exif/icc/xmp, de modo que los metadatos (GPS, fecha, dispositivo) se descartan.
+    Si la recodificación no ahorra bytes y el original no tiene metadatos ni hubo que
+    reducirlo, se devuelve el original (imágenes pequeñas que ya vienen comprimidas).
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as source:
+        has_metadata = _has_metadata(source)
+        image = ImageOps.exif_transpose(source)
+        original_size = image.size
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+        resized = image.size != original_size
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        if output_format == "webp":
+            image.save(output, format="WEBP", quality=quality, method=4)
+        else:
+            image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    if output.tell() >= len(data) and not resized and not has_metadata:
+        return data
+    return output.getvalue()
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _process_pool
+
+
+# =========================================================================
+# 3. CACHÉ DE DERIVADOS (por hash del original + parámetros de la variante)
+# =========================================================================
+
+def _variant_name() -> str:
+    return f"{IMAGE_MAX_DIMENSION}px_q{IMAGE_QUALITY}.{IMAGE_OUTPUT_FORMAT}"
+
+
+def derived_path(digest: str, variant: str) -> str:
+    return os.path.join(IMAGE_DERIVED_DIR, digest[:2], f"{digest}_{variant}")
+
+
+def _read_derived(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)  # mtime = último uso, para la poda por antigüedad
+        return data
+    except FileNotFoundError:
+        return None
+
+
+def _write_derived(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(partial_path, path)
+
+
+def prune_derived_cache(max_age: float = IMAGE_DERIVED_MAX_AGE_SECONDS) -> int:
+    """Elimina variantes no usadas en max_age segundos (se regeneran bajo demanda)."""
+    if not os.path.isdir(IMAGE_DERIVED_DIR):
+        return 0
+    now, removed = time.time(), 0
+    for directory, _, files in os.walk(IMAGE_DERIVED_DIR):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) >= max_age:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+# =========================================================================
+# 4. API PÚBLICA
+# =========================================================================
+
+async def prepare_for_model(data: bytes) -> Tuple[Optional[bytes], Optional[str]]:
+    """
+    Devuelve (bytes, mime) listos para Part.from_bytes. Las imágenes rasterizadas se
+    reducen a IMAGE_MAX_DIMENSION, se recodifican a IMAGE_OUTPUT_FORMAT y pierden el EXIF;
+    el resultado se cachea en disco por SHA-256 del original. Un formato no admitido, o una
+    imagen que Pillow no puede procesar, devuelve (None, None) y se omite la imagen: nunca
+    se envía el original con sus metadatos.
+    """
+    mime = sniff_mime(data)
+    if mime is None:
+        print("ADVERTENCIA IMAGEN: Formato de archivo no admitido para el análisis multimodal; se omite.")
+        return None, None
+    if mime not in _RASTER_MIMES:
+        return data, mime
+
+    output_mime = _OUTPUT_MIMES.get(IMAGE_OUTPUT_FORMAT, "image/jpeg")
+    digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+    path = derived_path(digest, _variant_name())
+
+    derived = await asyncio.to_thread(_read_derived, path)
+    from_cache = derived is not None
+    if from_cache:
+        stats["derived_hits"] += 1
+    else:
+        try:
+            loop = asyncio.get_running_loop()
+            derived = await loop.run_in_executor(
+                _get_process_pool(), _preprocess, data, IMAGE_MAX_DIMENSION, IMAGE_OUTPUT_FORMAT, IMAGE_QUALITY
+            )
+        except Exception as e:
+            # Sin preprocesado no hay garantía de quitar el EXIF/GPS: la imagen se omite
+            stats["failures"] += 1
+            print(f"ADVERTENCIA IMAGEN: No se pudo preprocesar la imagen ({e}); se omite del análisis.")
+            return None, None
+        stats["processed"] += 1
+        try:
+            await asyncio.to_thread(_write_derived, path, derived)
+        except OSError as e:
+            print(f"ADVERTENCIA IMAGEN: No se pudo guardar el derivado en caché: {e}")
+
+    stats["bytes_in"] += len(data)
+    stats["bytes_out"] += len(derived)
+    print(f"INFO: Imagen preparada para el modelo: {len(data)} -> {len(derived)} bytes "
+          f"(ahorro {len(data) - len(derived)} bytes{', derivado en caché' if from_cache else ''}).")
+    # El derivado puede ser el original (sin metadatos y ya más pequeño): su MIME manda
+    return derived, sniff_mime(derived) or output_mime
+
+
+def snapshot() -> Dict[str, Any]:
+    saved = stats["bytes_in"] - stats["bytes_out"]
+    return {
+        **stats,
+        "bytes_saved": saved,
+        "saved_ratio": round(saved / stats["bytes_in"], 3) if stats["bytes_in"] else 0.0,
+        "variant": _variant_name(),
+    }
+
+
+def shutdown_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,323 @@
+import asyncio
+import datetime
+import json
+import os
+import socket
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import and_, or_, update
+from sqlalchemy.exc import IntegrityError
+
+from config import (
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_INTERVAL,
+    JOB_RETRY_BASE_SECONDS,
+    JOB_WORKERS,
+)
+from database import session_scope
+from models import FulfillmentJob
+
+# Identificador del proceso que reclama trabajos (útil para depurar leases en Render)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Registro de manejadores: kind -> coroutine(job_id, payload) -> resultado serializable
+JobHandler = Callable[[int, Dict[str, Any]], Awaitable[Any]]
+# Se invoca una sola vez cuando la cola abandona el trabajo: coroutine(job_id, payload, error)
+GiveUpHandler = Callable[[int, Dict[str, Any], str], Awaitable[None]]
+_HANDLERS: Dict[str, JobHandler] = {}
+_GIVE_UP_HANDLERS: Dict[str, GiveUpHandler] = {}
+
+
+def register_handler(kind: str, handler: JobHandler, on_give_up: Optional[GiveUpHandler] = None):
+    """
+    Asocia un tipo de trabajo con la corrutina que lo ejecuta. on_give_up permite marcar
+    el fallo definitivo (agotados los intentos) fuera de la tabla de trabajos.
+    """
+    _HANDLERS[kind] = handler
+    if on_give_up is not None:
+        _GIVE_UP_HANDLERS[kind] = on_give_up
+
+
+def job_to_dict(job: FulfillmentJob) -> Dict[str, Any]:
+    """Representación pública de un trabajo (para el endpoint de estado): solo el id opaco."""
+    return {
+        "job_id": job.public_id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "run_after": job.run_after.isoformat() if job.run_after else None,
+        "last_error": job.last_error,
+        "result": json.loads(job.result) if job.result else None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+# =========================================================================
+# 1. OPERACIONES SÍNCRONAS SOBRE LA TABLA (se ejecutan vía asyncio.to_thread)
+# =========================================================================
+
+def enqueue_job(kind: str, payload: Dict[str, Any], dedupe_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Inserta un trabajo pendiente. Si ya existe uno con la misma dedupe_key
+    (ej. Stripe reenvía el evento), devuelve el existente sin duplicarlo.
+    """
+    with session_scope("job_queue") as db:
+        if dedupe_key:
+            existing = db.query(FulfillmentJob).filter(FulfillmentJob.dedupe_key == dedupe_key).first()
+            if existing:
+                return job_to_dict(existing)
+
+        now = datetime.datetime.utcnow()
+        job = FulfillmentJob(
+            public_id=uuid.uuid4().hex,
+            kind=kind,
+            dedupe_key=dedupe_key,
+            payload=json.dumps(payload),
+            status="pending",
+            attempts=0,
+            max_attempts=JOB_MAX_ATTEMPTS,
+            run_after=now,
+            created_at=now,
+            updated_at=now,
+        )
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Carrera entre dos entregas simultáneas del mismo evento
+            db.rollback()
+            existing = db.query(FulfillmentJob).filter(FulfillmentJob.dedupe_key == dedupe_key).first()
+            return job_to_dict(existing)
+        db.refresh(job)
+        return job_to_dict(job)
+
+
+def get_job(public_id: str) -> Optional[Dict[str, Any]]:
+    with session_scope("job_queue") as db:
+        job = db.query(FulfillmentJob).filter(FulfillmentJob.public_id == public_id).first()
+        return job_to_dict(job) if job else None
+
+
+def get_job_key(public_id: str) -> Optional[Dict[str, Any]]:
+    """Tipo y clave de idempotencia del trabajo (de ella se deriva su canal de streaming)."""
+    with session_scope("job_queue") as db:
+        row = (
+            db.query(FulfillmentJob.kind, FulfillmentJob.dedupe_key)
+            .filter(FulfillmentJob.public_id == public_id)
+            .first()
+        )
+        return {"kind": row.kind, "dedupe_key": row.dedupe_key} if row else None
+
+
+def _claimable_condition(now: datetime.datetime):
+    """Pendiente y vencido su backoff, o en ejecución con el lease expirado (worker caído)."""
+    return or_(
+        and_(FulfillmentJob.status == "pending", FulfillmentJob.run_after <= now),
+        and_(FulfillmentJob.status == "running", FulfillmentJob.lease_expires_at < now),
+    )
+
+
+def claim_next_job() -> Optional[Dict[str, Any]]:
+    """
+    Reclama un trabajo con semántica de lease: UPDATE condicional sobre la misma
+    condición de selección, de modo que solo un worker (o proceso) lo obtiene.
+    """
+    with session_scope("job_queue") as db:
+        now = datetime.datetime.utcnow()
+        candidate = (
+            db.query(FulfillmentJob.id)
+            .filter(_claimable_condition(now))
+            .order_by(FulfillmentJob.run_after)
+            .first()
+        )
+        if not candidate:
+            return None
+
+        claimed = db.execute(
+            update(FulfillmentJob)
+            .where(FulfillmentJob.id == candidate.id, _claimable_condition(now))
+            .values(
+                status="running",
+                attempts=FulfillmentJob.attempts + 1,
+                locked_by=WORKER_ID,
+                lease_expires_at=now + datetime.timedelta(seconds=JOB_LEASE_SECONDS),
+                updated_at=now,
+            )
+        )
+        db.commit()
+        if claimed.rowcount != 1:
+            # Otro worker lo reclamó primero
+            return None
+
+        job = db.query(FulfillmentJob).filter(FulfillmentJob.id == candidate.id).first()
+        return {
+            "id": job.id,
+            "kind": job.kind,
+            "payload": json.loads(job.payload or "{}"),
+            "attempts": job.attempts,
+            "max_attempts": job.max_attempts,
+        }
+
+
+def renew_lease(job_id: int):
+    with session_scope("job_queue") as db:
+        now = datetime.datetime.utcnow()
+        db.execute(
+            update(FulfillmentJob)
+            .where(FulfillmentJob.id == job_id, FulfillmentJob.locked_by == WORKER_ID)
+            .values(lease_expires_at=now + datetime.timedelta(seconds=JOB_LEASE_SECONDS))
+        )
+        db.commit()
+
+
+def complete_job(job_id: int, result: Any) -> bool:
+    """Marca 'completed' solo si el lease sigue siendo de este proceso (otro worker pudo retomarlo)."""
+    with session_scope("job_queue") as db:
+        updated = db.execute(
+            update(FulfillmentJob)
+            .where(FulfillmentJob.id == job_id, FulfillmentJob.locked_by == WORKER_ID)
+            .values(
+                status="completed",
+                result=json.dumps(result, default=str),
+                last_error=None,
+                locked_by=None,
+                lease_expires_at=None,
+                updated_at=datetime.datetime.utcnow(),
+            )
+        )
+        db.commit()
+        return updated.rowcount == 1
+
+
+def fail_job(job_id: int, attempts: int, max_attempts: int, error: str) -> Optional[str]:
+    """
+    Reprograma con backoff exponencial, o marca 'failed' si se agotaron los intentos.
+    Devuelve el nuevo estado, o None si el lease ya no es de este proceso.
+    """
+    with session_scope("job_queue") as db:
+        now = datetime.datetime.utcnow()
+        if attempts >= max_attempts:
+            values = {"status": "failed"}
+        else:
+            delay = JOB_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+            values = {"status": "pending", "run_after": now + datetime.timedelta(seconds=delay)}
+        values.update(last_error=error, locked_by=None, lease_expires_at=None, updated_at=now)
+        updated = db.execute(
+            update(FulfillmentJob)
+            .where(FulfillmentJob.id == job_id, FulfillmentJob.locked_by == WORKER_ID)
+            .values(**values)
+        )
+        db.commit()
+        return values["status"] if updated.rowcount == 1 else None
+
+
+# =========================================================================
+# 2. POOL ACOTADO DE WORKERS ASÍNCRONOS
+# =========================================================================
+
+class JobWorkerPool:
+    """
+    N workers asíncronos que reclaman trabajos de la tabla. El número de workers
+    acota la concurrencia de llamadas a Gemini sin importar el volumen de webhooks.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._stopping.clear()
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.workers)]
+        print(f"INFO: Cola de cumplimiento iniciada con {self.workers} workers ({WORKER_ID}).")
+
+    def notify(self):
+        """Despierta a los workers tras un enqueue (evita esperar al siguiente poll)."""
+        self._wakeup.set()
+
+    async def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        # Los trabajos en curso que no terminen quedan con lease y se reanudan en otro proceso
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker_loop(self, index: int):
+        while not self._stopping.is_set():
+            try:
+                job = await asyncio.to_thread(claim_next_job)
+            except Exception as e:
+                print(f"ERROR COLA: No se pudo reclamar trabajo (worker {index}): {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self._run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Un fallo al registrar el resultado (ej. la DB no responde) no mata al worker:
+                # el trabajo queda con lease y se retoma cuando expire
+                print(f"ERROR COLA: No se pudo registrar el trabajo {job['id']} (worker {index}): {e}")
+
+    async def _heartbeat(self, job_id: int):
+        while True:
+            await asyncio.sleep(max(JOB_LEASE_SECONDS / 3, 1))
+            try:
+                await asyncio.to_thread(renew_lease, job_id)
+            except Exception as e:
+                print(f"ERROR COLA: No se pudo renovar el lease del trabajo {job_id}: {e}")
+
+    async def _run_job(self, job: Dict[str, Any]):
+        handler = _HANDLERS.get(job["kind"])
+        if handler is None:
+            await asyncio.to_thread(fail_job, job["id"], job["max_attempts"], job["max_attempts"],
+                                    f"Tipo de trabajo desconocido: {job['kind']}")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"]))
+        try:
+            result = await handler(job["id"], job["payload"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"ERROR COLA: Trabajo {job['id']} falló (intento {job['attempts']}/{job['max_attempts']}): {e}")
+            status = await asyncio.to_thread(fail_job, job["id"], job["attempts"], job["max_attempts"], str(e))
+            if status == "failed":
+                await self._give_up(job, str(e))
+            elif status is None:
+                print(f"ADVERTENCIA COLA: El trabajo {job['id']} fue retomado por otro worker; se descarta este fallo.")
+        else:
+            if not await asyncio.to_thread(complete_job, job["id"], result):
+                print(f"ADVERTENCIA COLA: El trabajo {job['id']} fue retomado por otro worker; se descarta este resultado.")
+        finally:
+            heartbeat.cancel()
+
+    async def _give_up(self, job: Dict[str, Any], error: str):
+        on_give_up = _GIVE_UP_HANDLERS.get(job["kind"])
+        if on_give_up is None:
+            return
+        try:
+            await on_give_up(job["id"], job["payload"], error)
+        except Exception as e:
+            print(f"ERROR COLA: Falló el cierre del trabajo {job['id']} tras agotar intentos: {e}")
+
+
+worker_pool = JobWorkerPool()
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import pickle
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from config import PHI_AUTOMATON_CACHE, PHI_DICTIONARY_DIR
+
+# Etiqueta de redacción por archivo de diccionario (el resto usa el nombre del archivo en mayúsculas)
+DICTIONARY_LABELS = {
+    "nombres": "NOMBRE",
+    "apellidos": "NOMBRE",
+    "centros": "CENTRO",
+    "lugares": "LUGAR",
+}
+# excluidos.txt: frases que nunca se redactan (ej. 'Cruz Roja'); compiten en el autómata con esta etiqueta
+KEEP_LABEL = "_EXCLUIDO"
+EXCLUDED_DICTIONARY = "excluidos"
+# comunes.txt: términos que también son palabras comunes ('Blanco', 'Delgado'); no se redactan al inicio de oración
+COMMON_DICTIONARY = "comunes"
+# Conectores en minúscula admitidos dentro de un término de varias palabras ('Ciudad de México')
+_CONNECTORS = frozenset(("de", "del", "la", "las", "los", "el", "y", "e"))
+_SENTENCE_END = ".!?¡¿:;\n\r\f•"
+# Tratamientos abreviados: el punto de 'Dr. Blanco' no cierra oración
+_TITLE_ABBREVIATIONS = frozenset(("dr", "dra", "sr", "sra", "srta", "d", "dña", "lic", "prof", "enf"))
+
+# Plegado 1:1 (misma longitud) para que 'Maria' encuentre 'María' y los índices sigan alineados
+_FOLD = str.maketrans("áéíóúüàèìòùâêîôûäëïöÁÉÍÓÚÜÀÈÌÒÙÂÊÎÔÛÄËÏÖ", "aeiouuaeiouaeiouaeioaeiouuaeiouaeiouaeio")
+# Versión del formato serializado: cambiarla invalida las cachés en disco
+_CACHE_VERSION = 2
+
+
+def _fold(text: str) -> str:
+    folded = text.translate(_FOLD).lower()
+    if len(folded) != len(text):
+        # Caracteres cuya minúscula ocupa más de uno (ej. 'İ'): se dejan tal cual
+        folded = "".join(c.lower() if len(c.lower()) == 1 else c for c in text.translate(_FOLD))
+    return folded
+
+
+class AhoCorasick:
+    """
+    Autómata de Aho-Corasick sobre caracteres plegados. Encuentra todas las apariciones
+    de todos los términos en una sola pasada O(n + coincidencias), sin importar cuántos
+    términos tenga el diccionario.
+    """
+
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        # Por nodo: (longitud del término, etiqueta) de todos los términos que terminan ahí
+        self.outputs: List[List[Tuple[int, str]]] = [[]]
+        # Términos (plegados) que también son palabras comunes
+        self.common: Set[str] = set()
+        self.terms = 0
+
+    def add(self, term: str, label: str):
+        term = _fold(term.strip())
+        if not term:
+            return
+        node = 0
+        for char in term:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = next_node
+        if label == KEEP_LABEL:
+            # Una exclusión prevalece sobre el mismo término en un diccionario de PHI
+            if any(length == len(term) for length, _ in self.outputs[node]):
+                self.terms -= 1
+            self.outputs[node] = [(len(term), KEEP_LABEL)]
+            self.terms += 1
+        elif not any(length == len(term) for length, _ in self.outputs[node]):
+            self.outputs[node].append((len(term), label))
+            self.terms += 1
+
+    def build(self):
+        """Calcula los enlaces de fallo (BFS) y hereda las salidas del sufijo más largo."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+        return self
+
+    def iter_matches(self, text: str) -> Iterable[Tuple[int, int, str]]:
+        """Genera (inicio, fin, etiqueta) para cada aparición en el texto original."""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        for index, char in enumerate(_fold(text)):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, label in outputs[node]:
+                yield index - length + 1, index + 1, label
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _is_title_case(term: str) -> bool:
+    """
+    'María', 'Ciudad de México': cada palabra con inicial mayúscula y el resto en minúscula
+    (o un conector en minúscula). Rechaza 'paz', 'ANA' (siglas clínicas) y 'La paz'.
+    """
+    words = term.replace("-", " ").split()
+    if not words or words[0] in _CONNECTORS:
+        return False
+    for word in words:
+        if word in _CONNECTORS or word.isdigit():
+            continue
+        if not (word[0].isupper() and word[1:] == word[1:].lower()):
+            return False
+    return True
+
+
+def _at_sentence_start(text: str, start: int) -> bool:
+    index = start - 1
+    while index >= 0 and text[index] in " \t\"'«“(":
+        index -= 1
+    if index < 0:
+        return True
+    if text[index] == ".":
+        word_start = index
+        while word_start > 0 and text[word_start - 1].isalpha():
+            word_start -= 1
+        if text[word_start:index].lower() in _TITLE_ABBREVIATIONS:
+            return False
+    return text[index] in _SENTENCE_END
+
+
+def redact_terms(automaton: AhoCorasick, text: str, counts: Optional[Dict[str, int]] = None) -> str:
+    """
+    Redacta los términos del diccionario como [ETIQUETA]. Solo cuenta coincidencias de
+    palabra completa en forma de nombre propio ('García', no 'garcía' ni la sigla 'ANA');
+    una palabra común del diccionario ('Blanco') al inicio de oración no se redacta.
+    Entre solapamientos gana la más a la izquierda y, a igualdad, la más larga; si gana una
+    frase excluida ('Cruz Roja'), el texto queda tal cual.
+    """
+    candidates = []
+    for start, end, label in automaton.iter_matches(text):
+        if start > 0 and _is_word_char(text[start - 1]):
+            continue
+        if end < len(text) and _is_word_char(text[end]):
+            continue
+        if label != KEEP_LABEL:
+            term = text[start:end]
+            if not _is_title_case(term):
+                continue
+            if _fold(term) in automaton.common and _at_sentence_start(text, start):
+                continue
+        candidates.append((start, -end, label))
+    if not candidates:
+        return text
+
+    candidates.sort()
+    pieces, cursor = [], 0
+    for start, negative_end, label in candidates:
+        if start < cursor:
+            continue
+        end = -negative_end
+        pieces.append(text[cursor:start])
+        if label == KEEP_LABEL:
+            pieces.append(text[start:end])
+        else:
+            pieces.append(f"[{label}]")
+            if counts is not None:
+                counts[label] = counts.get(label, 0) + 1
+        cursor = end
+    pieces.append(text[cursor:])
+    return "".join(pieces)
+
+
+# =========================================================================
+# CONSTRUCCIÓN Y CACHÉ SERIALIZADA
+# =========================================================================
+
+def _dictionary_files(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".txt"))
+
+
+def _fingerprint(files: List[str]) -> str:
+    """Huella de los diccionarios (ruta, tamaño, mtime): si cambian, la caché se reconstruye."""
+    digest = hashlib.sha256(str(_CACHE_VERSION).encode())
+    for path in files:
+        stat = os.stat(path)
+        digest.update(f"{path}\x00{stat.st_size}\x00{stat.st_mtime_ns}\x00".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_automaton(files: List[str]) -> AhoCorasick:
+    automaton = AhoCorasick()
+    for path in files:
+        stem = os.path.splitext(os.path.basename(path))[0].lower()
+        label = KEEP_LABEL if stem == EXCLUDED_DICTIONARY else DICTIONARY_LABELS.get(stem, stem.upper())
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                if stem == COMMON_DICTIONARY:
+                    automaton.common.add(_fold(line.strip()))
+                else:
+                    automaton.add(line, label)
+    return automaton.build()
+
+
+def load_automaton(directory: str = PHI_DICTIONARY_DIR, cache_path: Optional[str] = PHI_AUTOMATON_CACHE) -> AhoCorasick:
+    """Carga el autómata desde la caché en disco si coincide la huella; si no, lo construye y la guarda."""
+    files = _dictionary_files(directory)
+    fingerprint = _fingerprint(files)
+
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached_fingerprint, automaton = pickle.load(f)
+            if cached_fingerprint == fingerprint:
+                return automaton
+        except Exception as e:
+            print(f"ADVERTENCIA PHI: Caché del autómata ilegible, se reconstruye: {e}")
+
+    automaton = build_automaton(files)
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            partial_path = f"{cache_path}.{os.getpid()}.part"
+            with open(partial_path, "wb") as f:
+                pickle.dump((fingerprint, automaton), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial_path, cache_path)
+        except OSError as e:
+            print(f"ADVERTENCIA PHI: No se pudo guardar la caché del autómata: {e}")
+    print(f"INFO: Autómata PHI construido con {automaton.terms} términos ({len(files)} diccionarios).")
+    return automaton
+
+
+_automaton: Optional[AhoCorasick] = None
+
+
+def get_automaton() -> AhoCorasick:
+    """Autómata del proceso (cada worker del pool de anonimización lo carga una vez)."""
+    global _automaton
+    if _automaton is None:
+        _automaton = load_automaton()
+    return _automaton
@@ -0,0 +1,90 @@
+import datetime
+import gzip
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+
+try:
+    import brotli
+except ImportError:  # Brotli es opcional: sin él solo se sirven gzip e identidad
+    brotli = None
+
+# Respuestas por debajo de este tamaño no compensan la compresión
+MIN_COMPRESS_BYTES = 512
+
+
+def compress_variants(body: bytes) -> Dict[str, bytes]:
+    """Codificaciones precalculadas (máxima compresión: se paga una sola vez)."""
+    variants = {}
+    if len(body) >= MIN_COMPRESS_BYTES:
+        if brotli is not None:
+            variants["br"] = brotli.compress(body, quality=11)
+        variants["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+    return variants
+
+
+def accepted_encodings(header: str) -> Dict[str, float]:
+    """Accept-Encoding -> {codificación: q}."""
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    return accepted
+
+
+class PrecompressedBody:
+    """
+    Cuerpo inmutable con sus variantes comprimidas, ETag y Last-Modified calculados al
+    construirlo. Servirlo solo elige la variante y compara cabeceras: sin trabajo por petición.
+    """
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str = "no-cache",
+                 last_modified: Optional[datetime.datetime] = None):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.variants = compress_variants(body)
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        modified = (last_modified or datetime.datetime.now(datetime.timezone.utc)).replace(microsecond=0)
+        self.last_modified = modified
+        self.last_modified_header = format_datetime(modified, usegmt=True)
+
+    def _not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            # Las variantes comprimidas comparten ETag (débil o fuerte, da igual para GET)
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return self.etag in tags or "*" in tags
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return parsedate_to_datetime(if_modified_since) >= self.last_modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Last-Modified": self.last_modified_header,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if self._not_modified(request):
+            return Response(status_code=304, headers=headers)
+
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, 0) > 0:
+                headers["Content-Encoding"] = encoding
+                return Response(self.variants[encoding], media_type=self.media_type, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
@@ -0,0 +1,157 @@
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+from typing import Dict
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from config import STATIC_BUILD_DIR, STATIC_SOURCE_DIR
+from services.precompressed import accepted_encodings, compress_variants
+
+MANIFEST_NAME = "manifest.json"
+# Solo se precomprimen formatos de texto (imágenes/fuentes ya vienen comprimidas)
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".mjs", ".svg", ".html", ".json", ".txt", ".map"}
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+_manifest: Dict[str, str] = {}
+
+# =========================================================================
+# 1. BUILD: nombres con hash de contenido, variantes .gz/.br y manifest
+# =========================================================================
+
+def _write_atomic(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(partial_path, path)
+
+
+def build_static_assets(source_dir: str = STATIC_SOURCE_DIR, out_dir: str = STATIC_BUILD_DIR) -> Dict[str, str]:
+    """
+    Copia cada archivo de source_dir como nombre.<hash>.ext en out_dir junto a sus
+    hermanos .gz/.br, y escribe manifest.json (ruta lógica -> ruta con hash).
+    Idempotente: un archivo sin cambios conserva su hash y no se reescribe.
+    Los builds anteriores se conservan para clientes con HTML antiguo en caché.
+    """
+    manifest = {}
+    for directory, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            source_path = os.path.join(directory, name)
+            logical = os.path.relpath(source_path, source_dir).replace(os.sep, "/")
+            with open(source_path, "rb") as f:
+                data = f.read()
+            stem, extension = os.path.splitext(logical)
+            hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+            manifest[logical] = hashed
+
+            target = os.path.join(out_dir, hashed)
+            if os.path.exists(target):
+                continue
+            _write_atomic(target, data)
+            if extension.lower() in COMPRESSIBLE_EXTENSIONS:
+                for encoding, compressed in compress_variants(data).items():
+                    if len(compressed) < len(data):
+                        _write_atomic(f"{target}.{'br' if encoding == 'br' else 'gz'}", compressed)
+
+    _write_atomic(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return manifest
+
+
+def _build_is_stale(source_dir: str, out_dir: str) -> bool:
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return True
+    built_at = os.path.getmtime(manifest_path)
+    return any(
+        os.path.getmtime(os.path.join(directory, name)) > built_at
+        for directory, _, files in os.walk(source_dir) for name in files
+    )
+
+
+def load_manifest(source_dir: str = STATIC_SOURCE_DIR, out_dir: str = STATIC_BUILD_DIR) -> Dict[str, str]:
+    """Carga el manifest, reconstruyendo antes si falta o si algún archivo de origen es más nuevo."""
+    global _manifest
+    if os.path.isdir(source_dir) and _build_is_stale(source_dir, out_dir):
+        _manifest = build_static_assets(source_dir, out_dir)
+        print(f"INFO: Recursos estáticos generados ({len(_manifest)} archivos) en {out_dir}.")
+    else:
+        try:
+            with open(os.path.join(out_dir, MANIFEST_NAME), encoding="utf-8") as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+    return _manifest
+
+
+def asset_url(logical_path: str) -> str:
+    """URL con hash para usar en plantillas: asset_url('css/style.css') -> /static/css/style.<hash>.css"""
+    return f"/static/{_manifest.get(logical_path, logical_path)}"
+
+
+# =========================================================================
+# 2. MONTAJE: variantes precomprimidas y caché inmutable
+# =========================================================================
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles que sirve el hermano .br/.gz si el cliente lo acepta (sin comprimir al vuelo)
+    y marca como immutable los nombres con hash. Las rutas lógicas sin hash se resuelven
+    vía manifest con revalidación (no-cache + ETag). FileResponse usa sendfile cuando el
+    servidor lo soporta.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("check_dir", False)
+        super().__init__(*args, **kwargs)
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            raise HTTPException(status_code=405)
+
+        logical = path.replace(os.sep, "/")
+        hashed = _manifest.get(logical)
+        cache_control = REVALIDATE_CACHE if hashed else IMMUTABLE_CACHE
+        if logical == MANIFEST_NAME:
+            cache_control = REVALIDATE_CACHE
+        target = hashed or logical
+
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        media_type = mimetypes.guess_type(target)[0] or "application/octet-stream"
+
+        full_path, stat_result, encoding = None, None, None
+        for candidate_encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if accepted.get(candidate_encoding, 0) > 0:
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, target + suffix)
+                if stat_result is not None:
+                    encoding = candidate_encoding
+                    break
+        if stat_result is None:
+            full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, target)
+        if stat_result is None:
+            raise HTTPException(status_code=404)
+
+        headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        response = FileResponse(full_path, stat_result=stat_result, media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return Response(status_code=304, headers={
+                key: value for key, value in response.headers.items()
+                if key in ("etag", "cache-control", "vary", "last-modified")
+            })
+        return response
+
+
+if __name__ == "__main__":
+    manifest = build_static_assets()
+    print(json.dumps(manifest, indent=2))
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+# Tiempo que un canal cerrado permanece en memoria para clientes que llegan tarde
+CHANNEL_RETENTION_SECONDS = 120
+
+Event = Tuple[str, Any]
+
+
+def format_sse(event: str, data: Any) -> str:
+    """Serializa un evento en formato Server-Sent Events (una sola línea de datos JSON)."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class StreamChannel:
+    """Canal en proceso con historial: un suscriptor tardío recibe lo ya emitido y luego lo nuevo."""
+
+    def __init__(self):
+        self.history: List[Event] = []
+        self.subscribers: Set[asyncio.Queue] = set()
+        self.closed = False
+
+    def publish(self, event: str, data: Any):
+        self.history.append((event, data))
+        for queue in self.subscribers:
+            queue.put_nowait((event, data))
+
+
+_channels: Dict[str, StreamChannel] = {}
+
+
+def open_channel(key: str) -> StreamChannel:
+    channel = _channels.get(key)
+    if channel is None or channel.closed:
+        channel = StreamChannel()
+        _channels[key] = channel
+    return channel
+
+
+def get_channel(key: str) -> Optional[StreamChannel]:
+    return _channels.get(key)
+
+
+def publish(key: str, event: str, data: Any):
+    channel = _channels.get(key)
+    if channel is not None and not channel.closed:
+        channel.publish(event, data)
+
+
+def close_channel(key: str, event: str, data: Any):
+    """Emite el evento final y programa la liberación del historial."""
+    channel = _channels.get(key)
+    if channel is None or channel.closed:
+        return
+    channel.publish(event, data)
+    channel.closed = True
+
+    def _drop():
+        if _channels.get(key) is channel:
+            del _channels[key]
+
+    asyncio.get_running_loop().call_later(CHANNEL_RETENTION_SECONDS, _drop)
+
+
+async def subscribe(key: str) -> AsyncIterator[Event]:
+    """Itera los eventos del canal (historial + nuevos) hasta que se cierra."""
+    channel = _channels.get(key)
+    if channel is None:
+        return
+
+    queue: asyncio.Queue = asyncio.Queue()
+    replay = list(channel.history)
+    closed = channel.closed
+    if not closed:
+        channel.subscribers.add(queue)
+    try:
+        for item in replay:
+            yield item
+        if closed:
+            return
+        while True:
+            event, data = await queue.get()
+            yield event, data
+            if channel.closed and queue.empty():
+                return
+    finally:
+        channel.subscribers.discard(queue)
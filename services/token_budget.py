@@ -0,0 +1,110 @@
+import math
+from typing import Any, Dict, Optional, Tuple
+
+from google.genai import types
+
+from services.gemini_client import GEMINI_MODEL
+
+# Estimación de respaldo para español: ~4 caracteres por token
+_CHARS_PER_TOKEN = 4
+_TRUNCATION_MARKER = "\n[…descripción recortada por límite de tokens del nivel…]\n"
+# Proporción del presupuesto que se conserva del inicio del texto (el resto, del final)
+_HEAD_SHARE = 0.7
+
+# =========================================================================
+# 1. CONTEO LOCAL DE TOKENS
+# =========================================================================
+
+_tokenizer: Any = None
+_tokenizer_loaded = False
+
+
+def _get_tokenizer():
+    """
+    Tokenizador local del SDK (requiere sentencepiece y protobuf). El primer uso descarga el
+    vocabulario (GitHub) a <tmp>/vertexai_tokenizer_model; el arranque de la app lo precarga
+    para que esa descarga no caiga en una petición. Si no está disponible se usa la
+    estimación por caracteres: sin llamadas de red por petición.
+    """
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        _tokenizer_loaded = True
+        try:
+            from google.genai.local_tokenizer import LocalTokenizer
+            _tokenizer = LocalTokenizer(model_name=GEMINI_MODEL)
+        except Exception as e:
+            print(f"INFO: Tokenizador local no disponible ({e}); se estiman los tokens por caracteres.")
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        try:
+            return tokenizer.count_tokens(text).total_tokens
+        except Exception:
+            pass
+    return math.ceil(len(text) / _CHARS_PER_TOKEN)
+
+
+def fit_to_budget(text: str, max_tokens: Optional[int]) -> Tuple[str, int, bool]:
+    """
+    Recorta el texto a max_tokens conservando el principio y el final (motivo de consulta
+    y datos más recientes), con una marca visible del recorte. Devuelve (texto, tokens, recortado).
+    """
+    tokens = count_tokens(text)
+    if not max_tokens or tokens <= max_tokens:
+        return text, tokens, False
+
+    # El conteo no es lineal en caracteres: se ajusta proporcionalmente hasta entrar
+    budget = max_tokens - count_tokens(_TRUNCATION_MARKER)
+    keep_chars = int(len(text) * budget / tokens)
+    for _ in range(5):
+        head = int(keep_chars * _HEAD_SHARE)
+        tail = keep_chars - head
+        fitted = text[:head].rstrip() + _TRUNCATION_MARKER + (text[-tail:].lstrip() if tail else "")
+        fitted_tokens = count_tokens(fitted)
+        if fitted_tokens <= max_tokens:
+            return fitted, fitted_tokens, True
+        keep_chars = int(keep_chars * max_tokens / fitted_tokens * 0.95)
+    return fitted, fitted_tokens, True
+
+
+# =========================================================================
+# 2. CONFIGURACIÓN DE GENERACIÓN Y USO REAL
+# =========================================================================
+
+def budget_signature(budget: Optional[Dict[str, Any]]) -> str:
+    """Parte de la clave de caché: el mismo prompt con otro límite produce otra respuesta."""
+    if not budget:
+        return ""
+    return "|".join(f"{key}={budget[key]}" for key in sorted(budget))
+
+
+def build_generation_config(system_instruction: str, budget: Optional[Dict[str, Any]]) -> types.GenerateContentConfig:
+    """
+    Límites del nivel aplicados por la API (no solo pedidos en prosa). En gemini-2.5 los
+    tokens de razonamiento cuentan dentro de max_output_tokens, así que se suman al tope.
+    """
+    if not budget:
+        return types.GenerateContentConfig(system_instruction=system_instruction)
+    thinking_budget = budget.get("thinking_budget", 0)
+    return types.GenerateContentConfig(
+        system_instruction=system_instruction,
+        max_output_tokens=budget["max_output_tokens"] + thinking_budget,
+        temperature=budget.get("temperature"),
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget),
+    )
+
+
+def usage_from_metadata(usage_metadata: Any) -> Dict[str, Optional[int]]:
+    """Tokens facturados según la respuesta del modelo (usage_metadata)."""
+    if usage_metadata is None:
+        return {"prompt_tokens": None, "completion_tokens": None, "thoughts_tokens": None}
+    return {
+        "prompt_tokens": usage_metadata.prompt_token_count,
+        "completion_tokens": usage_metadata.candidates_token_count,
+        "thoughts_tokens": usage_metadata.thoughts_token_count,
+    }
@@ -0,0 +1,465 @@
+import asyncio
+import hashlib
+import hmac
+import importlib.util
+import io
+import os
+import re
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+from google.genai import types
+
+from config import (
+    TTS_AUDIO_DIR,
+    TTS_AUDIO_FORMAT,
+    TTS_AUDIO_MAX_AGE_SECONDS,
+    TTS_CHUNK_CHARS,
+    TTS_CHUNK_CONCURRENCY,
+    TTS_FIRST_CHUNK_CHARS,
+    TTS_MODEL,
+    TTS_MP3_BITRATE,
+    TTS_TOKEN_SECRET,
+    TTS_VOICE,
+    TTS_WORKERS,
+)
+from services import gemini_client as gemini
+
+# El modelo devuelve PCM lineal de 16 bits mono; la tasa viene en el mimeType (audio/L16;rate=24000)
+_DEFAULT_SAMPLE_RATE = 24000
+_SPEECH_PROMPT = ("Di de forma natural y profesional, omitiendo cualquier mención a la puntuación "
+                  "o símbolos, solo el texto principal: ")
+_MEDIA_TYPES = {"mp3": "audio/mpeg", "wav": "audio/wav"}
+_READ_CHUNK_SIZE = 64 * 1024
+
+# MP3 requiere lameenc (wheel sin dependencias del sistema); sin él se sirve WAV
+if TTS_AUDIO_FORMAT == "mp3" and importlib.util.find_spec("lameenc") is None:
+    print("ADVERTENCIA TTS: lameenc no está instalado; el audio se almacenará como WAV sin comprimir.")
+    AUDIO_FORMAT = "wav"
+else:
+    AUDIO_FORMAT = TTS_AUDIO_FORMAT if TTS_AUDIO_FORMAT in _MEDIA_TYPES else "mp3"
+
+stats = {"synthesized": 0, "cache_hits": 0, "failures": 0, "pcm_bytes": 0, "encoded_bytes": 0,
+         "chunks_synthesized": 0, "streams": 0}
+
+# =========================================================================
+# 1. AUTORIZACIÓN: token firmado que liga el audio a un análisis con el add-on
+# =========================================================================
+
+def _text_digest(text: str) -> bytes:
+    return hashlib.sha256(text.strip().encode("utf-8")).digest()
+
+
+def issue_token(text: str) -> str:
+    """Se entrega junto al análisis cuando el add-on tts_audio está pagado o incluido en el nivel."""
+    return hmac.new(TTS_TOKEN_SECRET.encode("utf-8"), _text_digest(text), hashlib.sha256).hexdigest()
+
+
+def verify_token(text: str, token: str) -> bool:
+    return bool(token) and hmac.compare_digest(issue_token(text), token)
+
+
+# =========================================================================
+# 2. SÍNTESIS (Gemini TTS, bajo el mismo semáforo que el resto de llamadas)
+# =========================================================================
+
+def _speech_config() -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        response_modalities=["AUDIO"],
+        speech_config=types.SpeechConfig(
+            voice_config=types.VoiceConfig(
+                prebuilt_voice_config=types.PrebuiltVoiceConfig(voice_name=TTS_VOICE),
+            ),
+        ),
+    )
+
+
+def _sample_rate(mime_type: Optional[str]) -> int:
+    match = re.search(r"rate=(\d+)", mime_type or "")
+    return int(match.group(1)) if match else _DEFAULT_SAMPLE_RATE
+
+
+async def synthesize_pcm(text: str) -> Tuple[bytes, int]:
+    """Devuelve (PCM de 16 bits mono, tasa de muestreo) para el texto."""
+    response = await gemini.generate_content(_SPEECH_PROMPT + text, _speech_config(), model=TTS_MODEL)
+    candidate = response.candidates[0] if response.candidates else None
+    parts = candidate.content.parts if candidate and candidate.content else None
+    audio_parts = [part.inline_data for part in parts or []
+                   if part.inline_data and (part.inline_data.mime_type or "").startswith("audio/")]
+    if not audio_parts:
+        raise RuntimeError("La respuesta de Gemini TTS no contiene audio.")
+    return b"".join(part.data for part in audio_parts), _sample_rate(audio_parts[0].mime_type)
+
+
+# =========================================================================
+# 3. CODIFICACIÓN (se ejecuta en un proceso del pool)
+# =========================================================================
+
+def _encode_audio(pcm: bytes, sample_rate: int, audio_format: str, bitrate: int) -> bytes:
+    """PCM -> MP3 (CBR, mono) o WAV. A 48 kbps el MP3 ocupa ~8 veces menos que el WAV de 24 kHz."""
+    if audio_format == "mp3":
+        import lameenc
+
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(bitrate)
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_channels(1)
+        encoder.set_quality(2)
+        return bytes(encoder.encode(pcm) + encoder.flush())
+
+    output = io.BytesIO()
+    with wave.open(output, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return output.getvalue()
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=TTS_WORKERS)
+    return _process_pool
+
+
+async def encode_audio(pcm: bytes, sample_rate: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_process_pool(), _encode_audio, pcm, sample_rate,
+                                      AUDIO_FORMAT, TTS_MP3_BITRATE)
+
+
+# =========================================================================
+# 4. FRAGMENTACIÓN EN SECCIONES Y FRASES
+# =========================================================================
+
+# Encabezados markdown o líneas tipo 'Diagnóstico:' abren una sección nueva
+_SECTION_BREAK = re.compile(r"\n\s*\n|\n(?=\s*(?:#{1,6}\s|\*\*|[A-ZÁÉÍÓÚÑ][^\n.]{0,60}:\s*\n))")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?…;])\s+")
+_CLAUSE_BREAK = re.compile(r"(?<=[,:])\s+|\s+")
+
+
+def _split_long(sentence: str, limit: int) -> List[str]:
+    """Frase más larga que el límite: se corta por comas o, en último caso, por espacios."""
+    pieces, current = [], ""
+    for word in _CLAUSE_BREAK.split(sentence):
+        if current and len(current) + len(word) + 1 > limit:
+            pieces.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_for_speech(text: str, first_limit: int = TTS_FIRST_CHUNK_CHARS,
+                     limit: int = TTS_CHUNK_CHARS) -> List[str]:
+    """
+    Divide el análisis en fragmentos que terminan en frase completa. El primero es corto
+    (tiempo hasta el primer sonido) y un fragmento se cierra al acabar una sección si ya
+    ocupa la mitad del límite, para que las pausas caigan entre secciones.
+    """
+    chunks: List[str] = []
+    current = ""
+
+    def current_limit() -> int:
+        return first_limit if not chunks else limit
+
+    for section in _SECTION_BREAK.split(text.strip()):
+        section = section.strip()
+        if not section:
+            continue
+        for sentence in _SENTENCE_BREAK.split(section):
+            for piece in (_split_long(sentence, current_limit()) if len(sentence) > current_limit() else [sentence]):
+                if current and len(current) + len(piece) + 1 > current_limit():
+                    chunks.append(current)
+                    current = piece
+                else:
+                    current = f"{current} {piece}" if current else piece
+        if current and len(current) >= current_limit() // 2:
+            chunks.append(current)
+            current = ""
+        elif current:
+            current += "\n"
+    if current.strip():
+        chunks.append(current.strip())
+    return chunks
+
+
+# =========================================================================
+# 5. CACHÉ DIRECCIONADA POR CONTENIDO Y RENDERS EN CURSO
+# =========================================================================
+
+def audio_digest(text: str) -> str:
+    variant = (f"{TTS_MODEL}\x00{TTS_VOICE}\x00{AUDIO_FORMAT}\x00{TTS_MP3_BITRATE}\x00"
+               f"{TTS_FIRST_CHUNK_CHARS}\x00{TTS_CHUNK_CHARS}\x00")
+    return hashlib.sha256(variant.encode("utf-8") + _text_digest(text)).hexdigest()
+
+
+def audio_path(digest: str) -> str:
+    return os.path.join(TTS_AUDIO_DIR, digest[:2], f"{digest}.{AUDIO_FORMAT}")
+
+
+def media_type() -> str:
+    return _MEDIA_TYPES[AUDIO_FORMAT]
+
+
+def _write_audio(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(suffix=".part", dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(partial_path, path)
+
+
+def _touch_if_exists(path: str) -> bool:
+    try:
+        os.utime(path)  # mtime = último uso, para la poda por antigüedad
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class _Render:
+    """
+    Síntesis en curso de un análisis: un futuro por fragmento, resuelto con su audio
+    codificado. Los oyentes los consumen en orden; la tarea sigue aunque se desconecten,
+    de modo que el archivo completo queda en caché para la siguiente reproducción.
+    """
+
+    def __init__(self, digest: str, chunks: List[str]):
+        loop = asyncio.get_running_loop()
+        self.digest = digest
+        self.chunks = chunks
+        self.futures: List[asyncio.Future] = [loop.create_future() for _ in chunks]
+        self.error: Optional[BaseException] = None
+        self.task = loop.create_task(self._run())
+
+    def _fail_pending(self, error: BaseException):
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(error)
+                future.exception()  # marcado como leído: el error se registra una sola vez, aquí
+
+    async def _render_chunk(self, index: int, semaphore: asyncio.Semaphore) -> int:
+        # El semáforo es FIFO: los fragmentos entran al modelo en orden y el primero nunca espera
+        async with semaphore:
+            pcm, sample_rate = await synthesize_pcm(self.chunks[index])
+        # La codificación (pool de procesos) no ocupa turno: el siguiente fragmento ya se sintetiza
+        audio = await encode_audio(pcm, sample_rate)
+        if not self.futures[index].done():
+            self.futures[index].set_result(audio)
+        stats["chunks_synthesized"] += 1
+        return len(pcm)
+
+    async def _run(self):
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(TTS_CHUNK_CONCURRENCY)
+        tasks = [asyncio.ensure_future(self._render_chunk(i, semaphore)) for i in range(len(self.chunks))]
+        try:
+            pcm_sizes = await asyncio.gather(*tasks)
+            # Tramas MP3 de flujos independientes se concatenan sin más; WAV necesita una sola cabecera
+            if AUDIO_FORMAT == "mp3":
+                audio = b"".join(future.result() for future in self.futures)
+            else:
+                audio = await encode_audio(b"".join(_wav_frames(f.result()) for f in self.futures),
+                                           _wav_rate(self.futures[0].result()))
+            await asyncio.to_thread(_write_audio, audio_path(self.digest), audio)
+            stats["synthesized"] += 1
+            stats["pcm_bytes"] += sum(pcm_sizes)
+            stats["encoded_bytes"] += len(audio)
+            print(f"INFO: Audio TTS sintetizado ({self.digest[:12]}…, {len(self.chunks)} fragmentos, "
+                  f"{time.perf_counter() - started:.1f}s): {sum(pcm_sizes)} bytes PCM -> {len(audio)} bytes {AUDIO_FORMAT}.")
+        except Exception as e:
+            # Un fragmento fallido invalida el audio: no se siguen gastando llamadas al modelo
+            for task in tasks:
+                task.cancel()
+            stats["failures"] += 1
+            self.error = e
+            self._fail_pending(e)
+            print(f"ERROR TTS: Síntesis fallida ({self.digest[:12]}…): {e}")
+        finally:
+            _renders.pop(self.digest, None)
+
+
+def _wav_frames(wav_bytes: bytes) -> bytes:
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav:
+        return wav.readframes(wav.getnframes())
+
+
+def _wav_rate(wav_bytes: bytes) -> int:
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav:
+        return wav.getframerate()
+
+
+# Renders en curso por digest: dos clics u oyentes simultáneos comparten la misma síntesis
+_renders: Dict[str, _Render] = {}
+
+
+async def start_audio(text: str) -> Tuple[str, bool]:
+    """
+    Devuelve (digest, desde_caché) sin esperar a la síntesis. Si el audio no está en
+    caché arranca (o reutiliza) el render por fragmentos; stream_audio lo reproduce
+    a medida que se completa.
+    """
+    digest = audio_digest(text)
+    if await asyncio.to_thread(_touch_if_exists, audio_path(digest)):
+        stats["cache_hits"] += 1
+        return digest, True
+    if digest not in _renders:
+        _renders[digest] = _Render(digest, split_for_speech(text))
+    return digest, False
+
+
+def get_render(digest: str) -> Optional[_Render]:
+    """Render en curso para el digest, o None si no hay (terminado o nunca iniciado)."""
+    return _renders.get(digest)
+
+
+async def stream_audio(render: _Render) -> AsyncIterator[bytes]:
+    """
+    Audio del render en curso, fragmento a fragmento y en orden. Los fragmentos ya
+    sintetizados salen de inmediato (oyentes que llegan tarde), el resto según terminan.
+    Recibe el render obtenido al llegar la petición: si termina antes de que empiece
+    la respuesta, sus futures siguen disponibles y el cuerpo no queda vacío.
+    """
+    digest = render.digest
+    stats["streams"] += 1
+    if AUDIO_FORMAT != "mp3":
+        # Sin MP3 no hay flujo concatenable: se espera al archivo completo
+        await asyncio.shield(render.task)
+        if render.error is None:
+            for chunk in _iter_file_range(audio_path(digest), 0, os.path.getsize(audio_path(digest)) - 1):
+                yield chunk
+        return
+    for future in render.futures:
+        # shield: si el oyente se desconecta, se cancela su espera, no la síntesis compartida
+        try:
+            audio = await asyncio.shield(future)
+        except Exception:
+            return  # el render ya registró el error; el audio termina donde llegó
+        yield audio
+
+
+def prune_audio_cache(max_age: float = TTS_AUDIO_MAX_AGE_SECONDS) -> int:
+    """Elimina audios no reproducidos en max_age segundos (se vuelven a sintetizar bajo demanda)."""
+    if not os.path.isdir(TTS_AUDIO_DIR):
+        return 0
+    now, removed = time.time(), 0
+    for directory, _, files in os.walk(TTS_AUDIO_DIR):
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) >= max_age:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+# =========================================================================
+# 6. ENTREGA CON SOPORTE DE RANGE (el reproductor pide trozos al buscar)
+# =========================================================================
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    'bytes=inicio-fin' -> (inicio, fin) inclusivo. Devuelve None si la cabecera no es
+    un único rango válido (se sirve el archivo completo) y lanza RangeNotSatisfiable
+    si el rango queda fuera del archivo.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, dash, end_text = spec.strip().partition("-")
+    if not dash or not (start_text.isdigit() or end_text.isdigit()):
+        return None
+    if not start_text:
+        # Sufijo: los últimos N bytes
+        length = int(end_text)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    if end_text and not end_text.isdigit():
+        return None
+    start = int(start_text)
+    end = min(int(end_text), size - 1) if end_text else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def _iter_file_range(path: str, start: int, end: int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(_READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def audio_response(request: Request, digest: str) -> Response:
+    """Sirve el audio cacheado: 304 por ETag, 206 para Range y cacheable para siempre (es inmutable)."""
+    path = audio_path(digest)
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Audio no encontrado.")
+    etag = f'"{digest}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}:
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(_iter_file_range(path, start, end), status_code=206,
+                                     media_type=media_type(), headers=headers)
+
+    return FileResponse(path, media_type=media_type(), headers=headers)
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        **stats,
+        "format": AUDIO_FORMAT,
+        "rendering": len(_renders),
+        "compression_ratio": round(stats["pcm_bytes"] / stats["encoded_bytes"], 1) if stats["encoded_bytes"] else None,
+    }
+
+
+def shutdown_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+
+from config import UPLOAD_CHUNK_SIZE, UPLOAD_MAX_BYTES, UPLOAD_TEMP_DIR
+
+
+class SpooledUpload:
+    """
+    Archivo subido ya volcado a disco. Guarda el SHA-256 y el tamaño calculados
+    durante la copia, para no tener que releerlo.
+    """
+
+    def __init__(self, path: str, size: int, sha256: str, filename: Optional[str], content_type: Optional[str]):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.filename = filename
+        self.content_type = content_type
+
+    def read_bytes(self) -> bytes:
+        """Carga el archivo completo. Solo para consumidores que exigen bytes (ej. inline_data de Gemini)."""
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def cleanup(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _reject_too_large(max_bytes: int):
+    raise HTTPException(
+        status_code=413,
+        detail=f"El archivo supera el tamaño máximo permitido ({max_bytes // (1024 * 1024)} MB).",
+    )
+
+
+async def spool_upload(upload: UploadFile, max_bytes: int = UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """
+    Copia el UploadFile a un archivo temporal en bloques de UPLOAD_CHUNK_SIZE,
+    calculando el SHA-256 sobre la marcha. La memoria por subida queda acotada
+    a un bloque, y el límite de tamaño se aplica en cuanto se supera.
+    """
+    # Starlette conoce el tamaño cuando el multipart ya fue parseado: rechazo sin copiar nada
+    if upload.size is not None and upload.size > max_bytes:
+        _reject_too_large(max_bytes)
+
+    os.makedirs(UPLOAD_TEMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix="upload_", suffix=".part", dir=UPLOAD_TEMP_DIR)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    _reject_too_large(max_bytes)
+                digest.update(chunk)
+                await asyncio.to_thread(out.write, chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        await upload.close()
+
+    return SpooledUpload(path, size, digest.hexdigest(), upload.filename, upload.content_type)
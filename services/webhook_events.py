@@ -0,0 +1,83 @@
+import datetime
+import re
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from config import WEBHOOK_DEDUPE_LRU_SIZE
+from database import session_scope
+from models import WebhookEvent
+
+# Stripe serializa el id del evento al inicio del JSON: basta con mirar los primeros bytes
+_EVENT_ID_PATTERN = re.compile(rb'"id"\s*:\s*"(evt_[A-Za-z0-9_]+)"')
+_PEEK_BYTES = 512
+
+
+def peek_event_id(payload: bytes) -> Optional[str]:
+    """
+    Extrae el id del evento sin parsear el JSON completo. El valor NO está verificado:
+    solo sirve para responder rápido a duplicados ya registrados tras una verificación previa.
+    """
+    match = _EVENT_ID_PATTERN.search(payload[:_PEEK_BYTES])
+    return match.group(1).decode("ascii") if match else None
+
+
+class RecentEventIds:
+    """LRU acotado de ids ya vistos en este proceso (respuesta O(1) sin tocar la DB)."""
+
+    def __init__(self, max_size: int = WEBHOOK_DEDUPE_LRU_SIZE):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, event_id: str) -> bool:
+        if event_id in self._ids:
+            self._ids.move_to_end(event_id)
+            return True
+        return False
+
+    def add(self, event_id: str):
+        self._ids[event_id] = None
+        self._ids.move_to_end(event_id)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+
+recent_event_ids = RecentEventIds()
+
+
+# =========================================================================
+# REGISTRO PERSISTENTE (síncrono, se ejecuta vía asyncio.to_thread)
+# =========================================================================
+
+def is_recorded(event_id: str) -> bool:
+    with session_scope("webhook_events") as db:
+        return db.query(WebhookEvent.id).filter(WebhookEvent.event_id == event_id).first() is not None
+
+
+def record_event(event_id: str, event_type: str) -> bool:
+    """Registra el evento. Devuelve False si ya existía (índice UNIQUE sobre event_id)."""
+    with session_scope("webhook_events") as db:
+        db.add(WebhookEvent(
+            event_id=event_id,
+            event_type=event_type,
+            status="received",
+            received_at=datetime.datetime.utcnow(),
+        ))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return False
+        return True
+
+
+def mark_processed(event_id: str):
+    with session_scope("webhook_events") as db:
+        db.execute(
+            update(WebhookEvent)
+            .where(WebhookEvent.event_id == event_id)
+            .values(status="processed", processed_at=datetime.datetime.utcnow())
+        )
+        db.commit()
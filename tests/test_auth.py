@@ -0,0 +1,43 @@
+import os
+import tempfile
+
+# Base de datos y coste de bcrypt propios del test (se leen al importar database/utils)
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'auth.db')}"
+os.environ["BCRYPT_ROUNDS"] = "5"
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from passlib.context import CryptContext
+
+from database import SessionLocal, init_db
+from models import User
+from routes import auth
+
+init_db()
+app = FastAPI()
+app.include_router(auth.router)
+client = TestClient(app)
+
+
+def test_registro_y_login():
+    response = client.post("/auth/register", json={
+        "email": "voluntario@example.com", "password": "secreta", "role": "volunteer", "waiver_signed": True,
+    })
+    assert response.status_code == 200
+
+    assert client.post("/auth/login", json={"email": "voluntario@example.com", "password": "secreta"}).status_code == 200
+    assert client.post("/auth/login", json={"email": "voluntario@example.com", "password": "otra"}).status_code == 401
+
+
+def test_login_rehashea_hash_obsoleto():
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secreta")
+    with SessionLocal() as db:
+        db.add(User(email="antiguo@example.com", password=old_hash, role="volunteer"))
+        db.commit()
+
+    assert client.post("/auth/login", json={"email": "antiguo@example.com", "password": "secreta"}).status_code == 200
+
+    with SessionLocal() as db:
+        new_hash = db.query(User.password).filter(User.email == "antiguo@example.com").scalar()
+    assert new_hash != old_hash
+    assert new_hash.startswith("$2b$05$")
@@ -0,0 +1,36 @@
+import os
+
+from services.phi_automaton import _dictionary_files, build_automaton, redact_terms
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "phi_dictionaries")
+AUTOMATON = build_automaton(_dictionary_files(DICTIONARY_DIR))
+
+
+def redact(text):
+    return redact_terms(AUTOMATON, text)
+
+
+def test_redacta_nombres_propios():
+    assert redact("Acompañada por su hija Ana García desde Madrid.") == \
+        "Acompañada por su hija [NOMBRE] [NOMBRE] desde [LUGAR]."
+
+
+def test_no_redacta_siglas_en_mayusculas():
+    assert redact("anticuerpos ANA 1/160") == "anticuerpos ANA 1/160"
+
+
+def test_no_redacta_frases_excluidas():
+    assert redact("Trasladado por Cruz Roja al servicio.") == "Trasladado por Cruz Roja al servicio."
+
+
+def test_palabra_comun_al_inicio_de_oracion():
+    assert redact("Blanco, sin lesiones visibles.") == "Blanco, sin lesiones visibles."
+    assert redact("Refiere dolor. Delgado y pálido.") == "Refiere dolor. Delgado y pálido."
+    # Fuera del inicio de oración sigue siendo un apellido
+    assert redact("Lo atiende el Dr. Blanco.") == "Lo atiende el Dr. [NOMBRE]."
+    assert redact("Vive con Pedro Blanco.") == "Vive con [NOMBRE] [NOMBRE]."
+
+
+def test_no_redacta_palabras_en_minuscula():
+    assert redact("La paz del paciente mejoró.") == "La paz del paciente mejoró."
+    assert redact("Viaja a La Paz la semana próxima.") == "Viaja a [LUGAR] la semana próxima."
@@ -1,15 +1,20 @@
 # utils.py
+import asyncio
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict
+from typing import Any, Callable, Optional, Dict, Tuple
 
 # Importaciones de terceros
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from sqlalchemy import select
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy import event, inspect, select
 
 # 🛑 Importaciones de sus módulos locales
 # Asumimos que get_db está en database.py y el modelo User está en models.py
@@ -34,12 +39,24 @@ ALGORITHM = "HS256"
 # Tiempo de expiración ajustado a 24 horas (60 minutos * 24 horas)
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 
 
+# Coste de bcrypt configurable (cada +1 duplica el tiempo de CPU por hash/verificación)
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+# Pool dedicado y acotado para bcrypt: la librería libera el GIL al hashear, así que
+# los hilos escalan con los núcleos sin ocupar el threadpool por defecto de asyncio/Starlette.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 2)))
+
 # Contexto de passlib para hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
 
 # Esquema para inyección de dependencia
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token") 
 
+# Cachés de autenticación (por proceso): claims de JWT ya verificados y usuarios por email
+AUTH_CACHE_TTL_SECONDS = int(os.environ.get("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
 
 # ----------------------------------------------------------------------
 # 2. Funciones de Contraseña y Token
@@ -54,6 +71,29 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+async def hash_password_async(password: str) -> str:
+    """hash_password ejecutado en el pool de bcrypt (no bloquea el event loop)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, pwd_context.hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password ejecutado en el pool de bcrypt (no bloquea el event loop)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, pwd_context.verify, plain_password, hashed_password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    Verifica la contraseña y, si CryptContext.needs_update lo indica (ej. cambió BCRYPT_ROUNDS),
+    devuelve también el nuevo hash para guardarlo de forma transparente en el login.
+    """
+    if not hashed_password:
+        return False, None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_password_executor, pwd_context.verify_and_update, plain_password, hashed_password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
     Crea un token de acceso JWT.
@@ -74,7 +114,96 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 # ----------------------------------------------------------------------
-# 3. Integración de Base de Datos y Guardianes de Acceso (Dependencies)
+# 3. Cachés de Autenticación (TTL corto, tamaño acotado)
+# ----------------------------------------------------------------------
+
+class TTLCache:
+    """LRU con expiración por entrada. Seguro entre hilos (las dependencias sync corren en el threadpool)."""
+
+    def __init__(self, max_entries: int = AUTH_CACHE_MAX_ENTRIES, ttl_seconds: int = AUTH_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def pop_where(self, predicate: Callable[[Any], bool]):
+        with self._lock:
+            for key in [k for k, (_, value) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+
+token_claims_cache = TTLCache()
+user_cache = TTLCache()
+
+
+def decode_access_token(token: str) -> Dict[str, Any]:
+    """Decodifica y verifica el JWT, reutilizando el resultado hasta su 'exp' (como máximo el TTL)."""
+    claims = token_claims_cache.get(token)
+    if claims is not None:
+        return claims
+    claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    expires_in = claims["exp"] - time.time() if "exp" in claims else None
+    token_claims_cache.set(token, claims, expires_in)
+    return claims
+
+
+def _user_snapshot(user: User) -> Dict[str, Any]:
+    return {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs}
+
+
+def _user_from_snapshot(db: Session, snapshot: Dict[str, Any]) -> User:
+    # Copia nueva por petición, asociada a la sesión de la petición sin consultar la DB (load=False):
+    # nunca se comparte una instancia entre peticiones y las relaciones perezosas siguen funcionando
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+def invalidate_user_cache(email: Optional[str]):
+    """Descarta el usuario cacheado y los claims de sus tokens."""
+    if not email:
+        return
+    user_cache.pop(email)
+    token_claims_cache.pop_where(lambda claims: claims.get("sub") == email)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user_on_change(mapper, connection, target):
+    # Cambios de rol o contraseña (o cualquier columna) invalidan la entrada, incluido un email anterior
+    invalidate_user_cache(target.email)
+    for old_email in inspect(target).attrs.email.history.deleted or ():
+        invalidate_user_cache(old_email)
+
+
+# ----------------------------------------------------------------------
+# 4. Integración de Base de Datos y Guardianes de Acceso (Dependencies)
 # ----------------------------------------------------------------------
 
 def get_user_from_db(db: Session, email: str) -> Optional[User]:
@@ -83,9 +212,22 @@ def get_user_from_db(db: Session, email: str) -> Optional[User]:
     return db.execute(stmt).scalars().first()
 
 
+def get_cached_user(db: Session, email: str) -> Optional[User]:
+    """get_user_from_db con caché por email (solo se consulta la DB en un fallo de caché)."""
+    snapshot = user_cache.get(email)
+    if snapshot is None:
+        user = get_user_from_db(db, email=email)
+        if user is None:
+            return None
+        user_cache.set(email, _user_snapshot(user))
+        return user
+    return _user_from_snapshot(db, snapshot)
+
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
     """
     Función clave de seguridad. Valida el JWT y obtiene el objeto Usuario de SQLAlchemy.
+    Las dependencias encadenadas reutilizan el resultado por la caché de dependencias de FastAPI.
     """
     if not SECRET_KEY:
         raise HTTPException(
@@ -100,8 +242,8 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     )
     
     try:
-        # Decodificación del token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        # Decodificación del token (cacheada hasta su expiración)
+        payload = decode_access_token(token)
         # El identificador único (email) se extrae del campo 'sub'
         email: str = payload.get("sub") 
         
@@ -110,8 +252,8 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except JWTError:
         raise credentials_exception
     
-    # Obtener el objeto User de la DB
-    user = get_user_from_db(db, email=email)
+    # Obtener el objeto User (caché por email; DB solo en un fallo de caché)
+    user = get_cached_user(db, email=email)
     if user is None:
         raise credentials_exception
     